@@ -1,9 +1,12 @@
 
-import os, fnmatch, string
-from . import iterutils, model as flmd
-from .source import Source, SourceFile
+import os, re, gc, string, fnmatch, threading, time, asyncio
+from sys import intern
+from . import iterutils, discovery, parsecache, watch, httppool, model as flmd
+from .source import Source, SourceEnv, SourceFile, SourceFileStream, SourceHttp, DEFAULT_MAX_FILE_SIZE, load_all
+from . import source as flsrc
 import anyconfig
 from collections import OrderedDict
+from types import MappingProxyType
 
 
 DEFAULT_EXCLUDE_PATTERNS = ['*.tar','*.jar','*.zip','*.gz','*.swp','node_modules','target','.idea','*.hide','*save']
@@ -12,6 +15,23 @@ VALID_KEY_CHARS = [c for c in string.printable if c not in ['_'] ]
 DEFAULT_KEY_FILTER = lambda p, k, v: k == None or isinstance(k, int) or (isinstance(k, str) and len(k)<50 and all(c in string.printable for c in VALID_KEY_CHARS))
 DEFAULT_UNFLATTEN_SEPARATOR = '__'
 
+# max seconds arefresh runs merge and research steps before giving control back to the event loop
+DEFAULT_ASYNC_BUDGET = 0.005
+# seconds between attempts to take the Cfg lock from the event loop
+ASYNC_LOCK_POLL = 0.001
+
+# parent of the nodes under a key that unflatten drops. They are built but never indexed
+DROPPED = -1
+
+# a path a tree doesn't have
+_ABSENT = object()
+
+# a glob segment fnmatch treats as a pattern
+_MAGIC = re.compile('[*?[]')
+
+# registrations of an index entry with none
+_NO_MREGS = MappingProxyType({})
+
 
 
 def from_home_dir(root_path=None, include_os_env=False):
@@ -24,8 +44,9 @@ def from_file(filename, root_path=None, include_os_env=False):
 def from_dict(d, root_path=None, include_os_env=False):
     return Cfg(data=d, root_path=root_path, file_patterns=None, include_os_env=include_os_env)
 
-def from_os_env(root_path=None):
-    return Cfg(root_path=root_path, include_os_env=True, file_patterns=[])
+def from_os_env(root_path=None, patterns=None, strip_prefix=False):
+    return Cfg(root_path=root_path, include_os_env=True, os_env_patterns=patterns, os_env_strip_prefix=strip_prefix,
+               file_patterns=[])
 
 
 
@@ -69,8 +90,8 @@ def search(*args, **kwargs):
     return __GET_GLOBAL_FLANGE().search(*args, **kwargs)
 
 
-def refresh(gather=False, load=True, merge=True, research=True):
-    return __GET_GLOBAL_FLANGE().refresh(gather, load, merge, research)
+def refresh(gather=False, load=True, merge=True, research=True, incremental=False):
+    return __GET_GLOBAL_FLANGE().refresh(gather, load, merge, research, incremental)
 
 def info(path=None):
     return __GET_GLOBAL_FLANGE().info(path=path)
@@ -93,26 +114,70 @@ def register_default_model(name, model):
 
 
 
-class PathCacheObject(object):
+class SourceIds(object):
+    """
+    Small integer ids of sources, so the sources of an indexed path can be kept as a bitmask. Bit i of
+    a mask is the source with id i. Ids are never reused, so a mask in an older snapshot still decodes
+    to the same sources. Each gather starts new ids
+    """
+
+    def __init__(self):
+        self.sources = []
+        self.ids = {}
+        # the mask of each single source. Entries with one source, most of them, share the int
+        self.masks = []
+
+    def __repr__(self):
+        return '<SourceIds #sources={}>'.format(len(self.sources))
+
+
+    def mask(self, src):
+        """
+        :return: the mask of src alone. An id is given to src if it has none
+        """
+        i = self.ids.get(src)
+        if i is None:
+            i = self.ids[src] = len(self.sources)
+            self.sources.append(src)
+            self.masks.append(1 << i)
+        return self.masks[i]
 
-    def __init__(self, val=None, mregs=None, srcs=None, path=None, wrap=False):
 
-        if wrap:
-            # basic wrapper. untested. keep this around for experimentation. This could be used to
-            # keep the metadata this class holds in-place in the original data via substitution of the
-            # wrapped object. Then an index of paths wouldn't be necessary.
-            #
-            # copied from:
-            #   https://stackoverflow.com/questions/1443129/completely-wrap-an-object-in-python/1445289#1445289
-            self.__class__ = type(val.__class__.__name__,
-                                  (self.__class__, val.__class__),
-                                  {})
-            self.__dict__ = val.__dict__
+    def decode(self, mask):
+        """
+        :return: list of the sources in mask, in id order
+        """
+        srcs = []
+        while mask:
+            low = mask & -mask
+            srcs.append(self.sources[low.bit_length() - 1])
+            mask ^= low
+        return srcs
+
+
+
+
+
+class PathCacheObject(object):
+    """
+    Index entry of a path. There is one per indexed node, so it is kept small: slots, no registrations
+    dict until a model is added, and the path is the tuple the index is keyed by
+    """
 
+    __slots__ = ('val', 'path', 'ids', 'mask', '_mregs')
 
+    def __init__(self, val=None, mregs=None, srcs=None, path=None, ids=None, mask=0):
+        """
+        :param srcs: sources of the value
+        :param ids: SourceIds the sources are kept in. A new one if None
+        :param mask: sources as a mask of ids, in addition to srcs
+        """
         self.val = val
-        self.mregs = mregs if mregs else {}
-        self.srcs = srcs if srcs else set()
+        self._mregs = mregs if mregs else None
+        self.ids = ids if ids is not None else SourceIds()
+        self.mask = mask
+        for src in srcs or ():
+            self.add_src(src)
         self.path = path
 
 
@@ -123,16 +188,44 @@ class PathCacheObject(object):
         return PathCacheObject(path=pv[0], val=pv[1])
 
     def __repr__(self):
-        return "<PathCacheObject {}, #srcs={}, #instances={}>".format(self.path, len(self.srcs), len(self.mregs))
+        return "<PathCacheObject {}, #srcs={}, #instances={}>".format(self.path, bin(self.mask).count('1'), len(self.mregs))
+
+
+    def copy(self):
+        return PathCacheObject(val=self.val, mregs=dict(self._mregs) if self._mregs else None, path=self.path,
+                               ids=self.ids, mask=self.mask)
+
+
+    @property
+    def mregs(self):
+        """
+        Model registrations by model name. Read only, see add_model
+        """
+        return self._mregs if self._mregs is not None else _NO_MREGS
 
 
+    @property
+    def srcs(self):
+        """
+        Set of the sources of the value, decoded from the mask. Changing it doesn't change the object
+        """
+        return set(self.ids.decode(self.mask))
+
+    def has_src(self, src):
+        return bool(self.mask & self.ids.mask(src))
+
     def add_src(self, src):
-        self.srcs.add(src)
+        self.mask |= self.ids.mask(src)
+
+    def discard_src(self, src):
+        self.mask &= ~self.ids.mask(src)
 
     def add_model(self, model, v):
         # print 'add model called on ',  model
-        if model.name not in self.mregs:
-            self.mregs[model.name] = model.registration(v)
+        if self._mregs is None:
+            self._mregs = {}
+        if model.name not in self._mregs:
+            self._mregs[model.name] = model.registration(v)
 
 
     def val_equals(self, val):
@@ -160,19 +253,340 @@ class PathCacheObject(object):
 
 
 
+class PathTrie(object):
+    """
+    Trie of the paths of an index, keyed by path segment. A node is a dict of its children, or None
+    while it has none. The index has the parent of each path it has, so a path is in the trie if its
+    node is. The root path (None,) is the root node and isn't kept.
+
+    A trie made from another shares its nodes and copies a node the first time it changes it, the way
+    Build shares index entries with its base. The other trie is never changed
+    """
+
+    def __init__(self, paths=(), base=None):
+        """
+        :param paths: paths to add
+        :param base: trie to start from
+        """
+        self.root = dict(base.root) if base is not None else {}
+        # ids of the nodes this trie made or copied, and may change in place
+        self.owned = {id(self.root)}
+        self.size = base.size if base is not None else 0
+        for path in paths:
+            self.add(path)
+
+    def __repr__(self):
+        return '<PathTrie #paths={}>'.format(self.size)
+
+    def __len__(self):
+        return self.size
+
+
+    def __node(self, path):
+        # node at path, None for a node without children, _ABSENT if path isn't in the trie
+        node = self.root
+        for key in path:
+            if not node:
+                return _ABSENT
+            node = node.get(key, _ABSENT)
+            if node is _ABSENT:
+                return _ABSENT
+        return node
+
+
+    def __contains__(self, path):
+        return path != (None,) and self.__node(path) is not _ABSENT
+
+
+    def children(self, path=()):
+        """
+        :return: list of the keys of the children of path. Empty if path isn't in the trie
+        """
+        node = self.__node(path)
+        return list(node) if node else []
+
+
+    def add(self, path):
+        """
+        Add path, and its parents if they aren't in the trie
+        """
+        if path == (None,) or path in self:
+            return
+        owned = self.owned
+        node = self.root
+        last = len(path) - 1
+        for i, key in enumerate(path):
+            child = node.get(key, _ABSENT)
+            if child is _ABSENT:
+                child = node[key] = None
+                self.size += 1
+            if i == last:
+                return
+            if child is None:
+                child = node[key] = {}
+                owned.add(id(child))
+            elif id(child) not in owned:
+                child = node[key] = dict(child)
+                owned.add(id(child))
+            node = child
+
+
+    def walk(self, prefix=()):
+        """
+        Paths under prefix, prefix first if it is in the trie, then parents before children. A prefix
+        of () walks the whole trie
+        """
+        node = self.__node(prefix)
+        if node is _ABSENT:
+            return
+        if prefix:
+            yield prefix
+        stack = [(prefix, node)]
+        while stack:
+            path, node = stack.pop()
+            if node:
+                for key, child in reversed(list(node.items())):
+                    stack.append((path + (key,), child))
+            if path is not prefix:
+                yield path
+
+
+    def discard(self, path):
+        """
+        Remove path and the paths under it
+
+        :return: list of the removed paths, parents first
+        """
+        removed = list(self.walk(path)) if path and path != (None,) else []
+        if removed:
+            self.__writable(path[:-1]).pop(path[-1])
+            self.size -= len(removed)
+        return removed
+
+
+    def match(self, glob):
+        """
+        Paths that match glob. A segment of the glob is a key or a pattern for fnmatch, matched against
+        str of a key that isn't one. A segment of ** matches any number of segments, including none
+
+        :param glob: tuple of segments, or a string of them separated by /
+        """
+        if isinstance(glob, str):
+            glob = tuple(glob.strip('/').split('/')) if glob.strip('/') else ()
+        else:
+            glob = tuple(glob)
+        seen = set() if glob.count('**') > 1 else None
+        stack = [((), self.root, 0)]
+        while stack:
+            path, node, i = stack.pop()
+            if i == len(glob):
+                if path and (seen is None or path not in seen):
+                    if seen is not None:
+                        seen.add(path)
+                    yield path
+                continue
+            segment = glob[i]
+            if segment == '**':
+                for key, child in reversed(list(node.items()) if node else []):
+                    stack.append((path + (key,), child, i))
+                stack.append((path, node, i + 1))
+            elif not node:
+                continue
+            elif not _MAGIC.search(segment):
+                for key, child in reversed(list(node.items())):
+                    if key == segment or (type(key) is not str and str(key) == segment):
+                        stack.append((path + (key,), child, i + 1))
+            else:
+                for key, child in reversed(list(node.items())):
+                    if fnmatch.fnmatchcase(key if type(key) is str else str(key), segment):
+                        stack.append((path + (key,), child, i + 1))
+
+
+    def __writable(self, path):
+        # node at path, which must be in the trie, made or copied so this trie can change it
+        owned = self.owned
+        node = self.root
+        for key in path:
+            child = node[key]
+            if child is None:
+                child = node[key] = {}
+                owned.add(id(child))
+            elif id(child) not in owned:
+                child = node[key] = dict(child)
+                owned.add(id(child))
+            node = child
+        return node
+
+
+
+
+
+class Snapshot(object):
+    """
+    The data, path index and models of a Cfg at one generation. A refresh builds the next snapshot off
+    to the side and publishes it with a single assignment to Cfg.snapshot. A reader that takes the
+    snapshot once sees one consistent state, without locking, whatever is refreshed meanwhile.
+
+    A published snapshot is never changed. Neither should what it holds be by readers
+    """
+
+    __slots__ = ('data', 'path_index', 'models', 'trees', 'generation', '_path_trie', '_value_index')
+
+    def __init__(self, data, path_index, models, trees=None, generation=0, path_trie=None, value_index=None):
+        set_ = super(Snapshot, self).__setattr__
+        set_('data', data)
+        set_('path_index', path_index)
+        set_('models', models)
+        # the tree each merged source was built to, or None if data isn't the merge of all of them
+        set_('trees', trees)
+        set_('generation', generation)
+        set_('_path_trie', path_trie)
+        set_('_value_index', value_index)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('a snapshot is read only')
+
+    def __repr__(self):
+        return '<Snapshot generation={} #paths={}>'.format(self.generation, len(self.path_index))
+
+
+    @property
+    def path_trie(self):
+        """
+        PathTrie of the paths of path_index. Made the first time it is asked for, after which the builds
+        of later snapshots keep it up to date rather than make it again
+        """
+        trie = self._path_trie
+        if trie is None:
+            trie = PathTrie(self.path_index)
+            super(Snapshot, self).__setattr__('_path_trie', trie)
+        return trie
+
+
+    @property
+    def value_index(self):
+        """
+        iterutils.ValueIndex of data. Made the first time it is asked for, and kept by later snapshots
+        with the same data
+        """
+        index = self._value_index
+        if index is None:
+            index = iterutils.ValueIndex(self.data)
+            super(Snapshot, self).__setattr__('_value_index', index)
+        return index
+
+
+
+class Build(object):
+    """
+    The next snapshot while a refresh builds it. Starts empty, or from a published snapshot whose
+    index entries are shared until changed. See entry. Paths are added to and removed from the index
+    with index and unindex, which keep the path trie, if the base has one, up to date
+    """
+
+    def __init__(self, base=None):
+        if base is None:
+            self.data = {}
+            self.path_index = {}
+            self.models = flmd.DEFAULT_MODELS.copy()
+            self.trees = None
+            self.base_index = {}
+            self.path_trie = None
+            self.base = None
+        else:
+            self.data = base.data
+            self.path_index = dict(base.path_index)
+            self.models = base.models.copy()
+            self.trees = base.trees
+            self.base_index = base.path_index
+            self.path_trie = PathTrie(base=base._path_trie) if base._path_trie is not None else None
+            self.base = base
+
+
+    def entry(self, path):
+        """
+        :return: the index entry at path to change. An entry shared with the base snapshot is copied first
+        """
+        entry = self.path_index[path]
+        if self.base_index.get(path) is entry:
+            entry = self.path_index[path] = entry.copy()
+        return entry
+
+
+    def index(self, path, entry):
+        if self.path_trie is not None and path not in self.path_index:
+            self.path_trie.add(path)
+        self.path_index[path] = entry
+
+
+    def unindex(self, path):
+        # remove the entry at path, if there is one. The index has no paths under it left
+        if self.path_index.pop(path, None) is not None and self.path_trie is not None:
+            self.path_trie.discard(path)
+
+
+    def snapshot(self, generation):
+        value_index = self.base._value_index if self.base is not None and self.base.data is self.data else None
+        return Snapshot(self.data, self.path_index, self.models, self.trees, generation, self.path_trie, value_index)
+
+
+
+def _has(container, key):
+    if isinstance(container, dict):
+        return key in container
+    return isinstance(container, list) and isinstance(key, int) and 0 <= key < len(container)
+
+
+def _get(value, path):
+    # value at path in a built tree or merged data. _ABSENT if there is none
+    for key in path:
+        if not _has(value, key):
+            return _ABSENT
+        value = value[key]
+    return value
+
+
+def _walk(value):
+    # (path, value) of value and everything under it, parents first
+    stack = [((), value)]
+    while stack:
+        path, value = stack.pop()
+        yield path, value
+        if isinstance(value, dict):
+            stack.extend((path + (k,), v) for k, v in value.items())
+        elif isinstance(value, list):
+            stack.extend((path + (i,), v) for i, v in enumerate(value))
+
+
+
+
+
 class Cfg(object):
     
     def __init__(self, 
                 data=None,
                 include_os_env=True,
+                os_env_patterns=None,
+                os_env_strip_prefix=False,
                 root_path=None,
                 base_dir='.',
                 file_patterns=DEFAULT_FILE_PATTERNS,
                 file_exclude_patterns=DEFAULT_EXCLUDE_PATTERNS,
                 file_search_depth=0,
+                file_search_workers=discovery.DEFAULT_DISCOVERY_WORKERS,
+                discovery_manifest=None,
+                max_file_size=DEFAULT_MAX_FILE_SIZE,
+                stream_file_size=None,
+                load_workers=None,
+                load_mode='thread',
+                parse_cache=None,
+                urls=None,
+                http_timeout=httppool.DEFAULT_HTTP_TIMEOUT,
+                lazy=False,
                 unflatten_separator=DEFAULT_UNFLATTEN_SEPARATOR,
                 key_filter=DEFAULT_KEY_FILTER,
                 src_post_proc=None,
+                index_values=True,
                 gather=True,
                 load=True,
                 merge=True,
@@ -181,13 +595,38 @@ class Cfg(object):
 
         :param data: initial data. This is merged as is without regard to root_path
         :param include_os_env:
+        :param os_env_patterns: list of prefixes or glob patterns of the environment variables to include. None
+        includes every variable
+        :param os_env_strip_prefix: if True, remove the matched prefix from the names of included variables
         :param research_models:
-        :param root_path: the namespace/key under which to add all loaded config/data. If model instances are defined at top level this will be needed
+        :param root_path: the namespace/key under which to add all loaded config/data. If model instances are defined at top level this will be needed.
+        May also be a func(uri) giving the root_path of each file source as it is found, so that lazy loading
+        can tell which file holds which namespace without loading it. src_post_proc runs too late for that
         :param base_dir: directory or list of directories to search for config/data. ** order matters! later entries override earlier.
         :param file_patterns:
         :param file_exclude_patterns:
         :param file_search_depth:
+        :param file_search_workers: max number of threads used to list directories during gather
+        :param discovery_manifest: optional path of a file in which to record discovered files by directory
+        mtime. Later gathers only list directories that have changed since.
+        :param max_file_size: files larger than this many bytes are not parsed. None for no limit
+        :param stream_file_size: yaml and json files of at least this many bytes are parsed as a stream
+        of events during merge instead of being loaded into memory first. max_file_size does not apply
+        to them. None to never stream
+        :param load_workers: number of threads or processes used to parse file sources. None parses one at a time
+        :param load_mode: 'thread' or 'process' pool for load_workers
+        :param parse_cache: persistent cache of parsed files. True for the default directory, a directory
+        path, or a parsecache.ParseCache
+        :param urls: url or list of http(s) urls to fetch config from. They are merged after the files and, on
+        refresh, only fetched again if changed
+        :param http_timeout: seconds to wait to connect to and for each read from a url
+        :param lazy: if True, file sources are not loaded up front. A source is loaded and merged the first
+        time a search touches its namespace (root_path). Sources without a root_path are loaded on the
+        first search
         :param unflatten_separator:
+        :param index_values: if True, a search by values without a path looks the values up in an inverted
+        index of the data instead of testing every node. The index is made by the first such search after
+        a refresh
         """
 
         # save params
@@ -195,7 +634,23 @@ class Cfg(object):
         self.file_patterns = [file_patterns] if isinstance(file_patterns, str) else file_patterns
         self.file_exclude_patterns = file_exclude_patterns
         self.file_search_depth = file_search_depth
+        self.file_search_workers = file_search_workers
+        self.discovery_manifest = discovery_manifest
+        self.max_file_size = max_file_size
+        self.stream_file_size = stream_file_size
+        self.load_workers = load_workers
+        self.load_mode = load_mode
+        if parse_cache is True:
+            parse_cache = parsecache.ParseCache()
+        elif isinstance(parse_cache, str):
+            parse_cache = parsecache.ParseCache(parse_cache)
+        self.parse_cache = parse_cache
+        self.urls = [urls] if isinstance(urls, str) else (urls or [])
+        self.http_timeout = http_timeout
+        self.lazy = lazy
         self.include_os_env = include_os_env
+        self.os_env_patterns = os_env_patterns
+        self.os_env_strip_prefix = os_env_strip_prefix
         self.root_path = root_path
         self.init_data = data
         # self.gather = gather
@@ -204,16 +659,23 @@ class Cfg(object):
 
         self.key_filter = key_filter
         self.src_post_proc = src_post_proc
+        self.index_values = index_values
 
         self.base_dir = base_dir
         if isinstance(self.base_dir, str):
             self.base_dir = [self.base_dir]
 
         # init data
-        self.data = {}
+        self.snapshot = Snapshot({}, {}, flmd.DEFAULT_MODELS.copy())
         self.sources = []
-        self.path_index = {}
-        self.models = flmd.DEFAULT_MODELS.copy()
+        self.source_ids = SourceIds()
+        self.walked_dirs = {}
+        self.watcher = None
+        self.on_change = None
+        self.lock = threading.RLock()
+        # serializes arefresh calls on the event loop. The thread lock is reentrant for the loop thread
+        self.alock = None
+        self.building = None
 
         # function to give to Source objects so register themselves with the path_index
         # self.source_indexer = lambda src, p, k, v: self.__visit_index_path(self.path_index, src, p, k, v)
@@ -223,6 +685,37 @@ class Cfg(object):
         self.refresh(gather, load, merge, research)
 
 
+    # the state of the published snapshot. Take self.snapshot once instead to read more than one consistently
+
+    @property
+    def data(self):
+        return self.snapshot.data
+
+    @property
+    def path_index(self):
+        return self.snapshot.path_index
+
+    @property
+    def path_trie(self):
+        return self.snapshot.path_trie
+
+    @property
+    def value_index(self):
+        return self.snapshot.value_index
+
+    @property
+    def models(self):
+        return self.snapshot.models
+
+    @property
+    def trees(self):
+        return self.snapshot.trees
+
+    @property
+    def generation(self):
+        return self.snapshot.generation
+
+
     #
     #
     #   Flange Cfg() init methods
@@ -230,53 +723,179 @@ class Cfg(object):
     #
 
     def clear_data(self):
+        with self.lock:
+            self.__publish(Build())
 
-        if self.data:
-            del self.data
-            self.data = {}
-        if self.path_index:
-            del self.path_index
-            self.path_index = {}
-        if self.models:
-            del self.models
-            self.models = flmd.DEFAULT_MODELS.copy()
+
+    def __publish(self, build):
+        self.snapshot = build.snapshot(self.snapshot.generation + 1)
+
+
+    def refresh(self, gather=False, load=True, merge=True, research=True, incremental=False):
+        """
+        :param incremental: only reload sources whose files changed (by size and mtime) since they were
+        loaded. If nothing changed then nothing is merged or researched. Otherwise, if merging and
+        researching, only the parts of the data the changed sources contribute to are merged again
+        :return: list of the sources that were loaded
+        """
+
+        with self.lock:
+            steps = self.__refresh_steps(gather, load, merge, research, incremental)
+            result = None
+            try:
+                while True:
+                    job = steps.send(result)
+                    result = job() if job else None
+            except StopIteration as e:
+                return e.value
 
 
-    def refresh(self, gather=False, load=True, merge=True, research=True):
+    @classmethod
+    async def create(cls, *args, **kwargs):
+        """
+        Construct a Cfg from a coroutine without blocking the event loop. Takes the same arguments as
+        Cfg(). The initial gather, load, merge and research are done by arefresh
+        """
+        steps = dict((k, kwargs.pop(k, True)) for k in ('gather', 'load', 'merge', 'research'))
+        cfg = cls(*args, gather=False, load=False, merge=False, research=False, **kwargs)
+        await cfg.arefresh(**steps)
+        return cfg
+
+
+    async def arefresh(self, gather=False, load=True, merge=True, research=True, incremental=False,
+                       budget=DEFAULT_ASYNC_BUDGET):
+        """
+        Same as refresh for use from a coroutine. Gathering and loading run on the loop's default
+        executor. Merge and research run on the event loop in steps, giving control back to the loop
+        every 'budget' seconds.
+
+        :param budget: max seconds to run merge and research steps between returns to the event loop
+        :return: list of the sources that were loaded
+        """
+        loop = asyncio.get_event_loop()
+        if self.alock is None:
+            self.alock = asyncio.Lock()
 
+        async with self.alock:
+
+            # don't block the loop waiting on a refresh in another thread
+            while not self.lock.acquire(blocking=False):
+                await asyncio.sleep(ASYNC_LOCK_POLL)
+
+            try:
+                return await self.__arun(loop, self.__refresh_steps(gather, load, merge, research, incremental), budget)
+            finally:
+                self.lock.release()
+
+
+    async def __arun(self, loop, steps, budget):
+        # A full collection of a large heap can take tens of milliseconds and building allocates enough
+        # to trigger several. Automatic collection is off while stepping and the young generations are
+        # collected at each return to the loop instead
+        collect = gc.isenabled()
+        gc.disable()
+        try:
+            result = None
+            started = time.perf_counter()
+            while True:
+                try:
+                    job = steps.send(result)
+                except StopIteration as e:
+                    return e.value
+
+                result = None
+                if job:
+                    result = await loop.run_in_executor(None, job)
+                    started = time.perf_counter()
+                elif time.perf_counter() - started > budget:
+                    if collect:
+                        gc.collect(1)
+                    await asyncio.sleep(0)
+                    started = time.perf_counter()
+        finally:
+            if collect:
+                gc.enable()
+
+
+    def __refresh_steps(self, gather, load, merge, research, incremental):
+        """
+        Generator of refresh steps. Blocking work (file system and parsing) is yielded as a function for
+        the caller to run, and sent back its result. Otherwise None is yielded between steps of merge and
+        research. The return value is the list of loaded sources
+        """
         clear = False
+        loaded = []
         if gather:
-            self.gather_sources()
+            yield self.gather_sources
             clear = True
         if load:
-            self.load_sources()
+            if incremental and not gather:
+                loaded = yield lambda: [s for s in self.sources if s.changed() and (s.loaded or not self.lazy)]
+                yield lambda: load_all(loaded, self.load_workers, self.load_mode)
+                if not loaded:
+                    return loaded
+                if merge and research and (yield from self.__remerge_steps(loaded)):
+                    return loaded
+            else:
+                loaded = [s for s in self.sources if s.loaded or not self.lazy]
+                yield self.load_sources
             clear = True
 
-        if clear:
-            self.clear_data()
+        if not clear:
+            # merge and research over the current state
+            if merge or research:
+                yield from self.__rebuild_steps(merge, research, self.snapshot)
+            return loaded
 
-        if merge:
-            self.merge_sources()
-        if research:
-            self.research_models()
+        yield from self.__rebuild_steps(merge, research)
+        return loaded
 
 
+    def __rebuild_steps(self, merge=True, research=True, base=None):
+        """
+        Merge and research into a new Build and then publish it
+
+        :param base: snapshot to build on. None to start empty
+        """
+        self.building = Build(base)
+        try:
+            if merge:
+                yield from self.__merge_steps()
+            if research:
+                yield from self.__research_steps()
+            built = self.building
+        finally:
+            self.building = None
+        self.__publish(built)
 
-    def gather_sources(self):
 
-        if self.sources:
-            del self.sources
 
+    def gather_sources(self):
+
+        # http sources are kept so their validators are sent with the next fetch
+        previous = dict((s.uri, s) for s in self.sources if isinstance(s, SourceHttp))
+        self.sources = []
+        self.source_ids = SourceIds()
         self.visited_uris = set()
+        self.walked_dirs = {}
 
 
         if self.file_patterns:
-            for dir in self.base_dir:
-                self.sources.extend(self.__get_file_sources(dir))
+            self.sources.extend(self.__get_file_sources(self.base_dir))
+
+        for url in self.urls:
+            if url not in self.visited_uris:
+                src = previous.get(url) or SourceHttp(
+                    url, self.root_path(url) if callable(self.root_path) else self.root_path, timeout=self.http_timeout)
+                self.sources.append(src)
+                self.visited_uris.add(url)
+
+        if self.watcher:
+            self.watcher.sync(self.walked_dirs)
 
         if self.include_os_env:
             # Dont use root path
-            self.sources.append(Source('os_env', '', os.environ.copy()))
+            self.sources.append(SourceEnv('os_env', '', self.os_env_patterns, self.os_env_strip_prefix))
 
         if self.init_data:
             # Dont use root path
@@ -285,65 +904,426 @@ class Cfg(object):
 
 
     def load_sources(self):
-        for s in self.sources:
-            s.load()
+        # in lazy mode only the sources that have already been needed are (re)loaded
+        sources = [s for s in self.sources if s.loaded] if self.lazy else self.sources
+        load_all(sources, self.load_workers, self.load_mode)
+
+
+    def __namespace(self, src):
+        """
+        :return: the top level key the source contents are merged under. None for the top level
+        """
+        if not src.root_path:
+            return None
+        return next(iter(iterutils.unflatten({src.root_path: None}, self.unflatten_separator)), None)
+
+
+    def __load_for_path(self, path):
+        """
+        Lazy mode. Load and merge the sources not yet loaded that could contribute to a search of path
+        """
+        if not [s for s in self.sources if not s.loaded]:
+            return
+        if self.alock is not None and self.alock.locked():
+            # an async refresh is part way through. answer from the state before it
+            return
+
+        # The first path segment selects the namespace, unless it is a wildcard
+        head = None
+        if isinstance(path, tuple):
+            head = path[0] if path else None
+        elif path:
+            head = path.split('/')[0]
+        if isinstance(head, str) and (not head or discovery.PatternSet.MAGIC.search(head)):
+            head = None
+
+        with self.lock:
+            pending = [s for s in self.sources
+                       if not s.loaded and (head is None or self.__namespace(s) in (None, head))]
+            if pending:
+                load_all(pending, self.load_workers, self.load_mode)
+                iterutils.run_steps(self.__rebuild_steps())
 
 
     def merge_sources(self):
+        with self.lock:
+            iterutils.run_steps(self.__rebuild_steps(research=False, base=self.snapshot))
+
+
+    def __merge_steps(self):
 
         # process sources with called provided function. This gives the caller a chance to
         # shape things up or set the src path prior to the filter, index and merge
-        dlist = []
+        target = self.building
+        trees = OrderedDict()
         for s in self.sources:
 
-            if s.error:
+            if s.error or not s.loaded:
                 continue
 
             if self.src_post_proc:
                 self.src_post_proc(s)
 
-            d = {s.root_path: s.contents} if s.root_path else s.contents
-            # print d.keys()
-            e = iterutils.unflatten(d, self.unflatten_separator)
-            # print 'after unflatten', e
-            dlist.append(iterutils.remap(e, reraise_visit=True, enter=lambda p, k, v: self.__filter_and_index(s, p, k, v)))
-            # e =  {'test': {'exclude': [['192.168.0.0/16'], ['172.16.0.0/12', '10.0.0.0/8'], '10.1.3.0/24']}}
-            # dlist.append(iterutils.remap(e, enter=lambda p, k, v: self.__filter_and_index(s, p, k, v)))
+            events = s.events() if isinstance(s, SourceFileStream) else flsrc.walk_events(s.contents)
+            try:
+                trees[s] = yield from self.__build_steps(s, events)
+            except Exception as e:
+                s.error = e
 
 
         # then merge, putting the content under the root path for each source
-        self.data = {}
-        failed = []
-        for d in dlist:
-            try:
-                # print 'merging ', d
-                anyconfig.merge(self.data, d)
-            except:
-                failed.append(d)
+        target.data, failed = yield from iterutils.merge_all_steps(list(trees.values()))
+        # a partly merged tree can't be merged again on its own
+        target.trees = None if failed else trees
+
+
+    def __remerge_steps(self, changed):
+        """
+        Merge again after some sources changed, were added or were removed, without a full rebuild. The
+        tree each source was built to is kept from the last merge. Only the paths the changed sources had
+        before or have now are visited. Along them the data is merged again from the trees that have
+        each path, their index entries are rebuilt and the models researched where the data changed.
+        The rest of the data, index and registrations is kept. The result is swapped in at the end, as
+        with a rebuild.
+
+        A generator of steps like remap_steps
+
+        :param changed: sources that were loaded again, added or removed since the last merge
+        :return: False, with nothing changed, if a full rebuild is needed instead. That is if the last
+        merge failed part way, a merge or key filter fails, or a plugin model is defined where the data
+        changed
+        """
+        base = self.snapshot
+        if base.trees is None:
+            return False
+
+        build = Build(base)
+        models = build.models
+        path_index = build.path_index
+        trees = base.trees.copy()
+        old_trees = []
+        new_trees = []
+        countdown = iterutils.REMAP_STEP_ITEMS
+
+        self.building = build
+        try:
+            for s in OrderedDict.fromkeys(changed):
+                old_trees.append(trees.pop(s, None))
+                if s.error or not s.loaded or s not in self.sources:
+                    continue
+                if self.src_post_proc:
+                    self.src_post_proc(s)
+                events = s.events() if isinstance(s, SourceFileStream) else flsrc.walk_events(s.contents)
+                try:
+                    trees[s] = yield from self.__build_steps(s, events, index=False)
+                    new_trees.append(trees[s])
+                except Exception as e:
+                    s.error = e
+            old_trees = [t for t in old_trees if t is not None]
+            build.trees = OrderedDict((s, trees[s]) for s in self.sources if s in trees)
+
+            # (source, value) of each tree that has a path, in merge order
+            contributors = {(): list(build.trees.items())}
+            def present(path):
+                found = contributors.get(path)
+                if found is None:
+                    key = path[-1]
+                    found = contributors[path] = [(s, c[key]) for s, c in present(path[:-1]) if _has(c, key)]
+                return found
+
+            # merge. The mappings of the changed trees are followed down as long as every tree that has
+            # the path has a mapping there, copying the merged mappings on the way. Below that the
+            # values are merged again
+            build.data = dict(base.data)
+            ancestors = [((), base.data, build.data)]
+            merged_again = []
+            stack = [((), build.data)]
+            while stack:
+                path, merged = stack.pop()
+                keys = OrderedDict()
+                for tree in old_trees + new_trees:
+                    node = _get(tree, path)
+                    if isinstance(node, dict):
+                        keys.update(dict.fromkeys(node))
+
+                for key in keys:
+                    countdown -= 1
+                    if not countdown:
+                        countdown = iterutils.REMAP_STEP_ITEMS
+                        yield
+                    sub = path + (key,)
+                    values = [v for s, v in present(sub)]
+                    old = merged.get(key, _ABSENT)
+                    if not values:
+                        new = _ABSENT
+                        merged.pop(key, None)
+                    elif len(values) == 1:
+                        new = merged[key] = values[0]
+                    elif (isinstance(old, dict) and all(isinstance(v, dict) for v in values)
+                          and all(isinstance(_get(t, sub), dict) or _get(t, sub) is _ABSENT for t in old_trees)):
+                        new = merged[key] = old.copy()
+                        ancestors.append((sub, old, new))
+                        stack.append((sub, new))
+                        continue
+                    else:
+                        folded, failed = yield from iterutils.merge_all_steps([{key: v} for v in values])
+                        if failed:
+                            return False
+                        new = merged[key] = folded[key]
+                    merged_again.append((sub, old, new))
+
+            # plugin models are found in the whole of the data. One where the data changed needs a rebuild
+            def is_plugin(v):
+                try:
+                    return flmd.PLUGIN_MODEL.validator(v)
+                except Exception:
+                    return False
+
+            for path, old, new in ancestors:
+                if is_plugin(old) or is_plugin(new):
+                    return False
+            for path, old, new in merged_again:
+                for value in (old, new):
+                    if value is not _ABSENT and (
+                            yield from iterutils.research_steps({'': value}, query=lambda p, k, v: is_plugin(v))):
+                        return False
+
+            # index. An entry is built again, the way __index_path would, from each tree with the path
+            # whose key filter passed it and all its parents
+            passed = {}
+            def indexed(s, path, value):
+                ok = passed.get((s, path))
+                if ok is None:
+                    parent = path[:-1]
+                    if path:
+                        ok = indexed(s, parent, _get(build.trees[s], parent))
+                    ok = passed[(s, path)] = bool((path == () or ok) and (
+                        not self.key_filter or self.key_filter(parent, path[-1] if path else None, value)))
+                return ok
+
+            fresh = set()
+            for tree in old_trees + new_trees:
+                for path, value in _walk(tree):
+                    full = path or (None,)
+                    if full in fresh:
+                        continue
+                    countdown -= 1
+                    if not countdown:
+                        countdown = iterutils.REMAP_STEP_ITEMS
+                        yield
+                    entry = None
+                    for s, v in present(path):
+                        if not indexed(s, path, v):
+                            continue
+                        if entry is None:
+                            entry = PathCacheObject(val=v, path=full, ids=self.source_ids, mask=self.source_ids.mask(s))
+                        elif not entry.val_equals(v):
+                            entry.add_src(s)
+                    if entry is None:
+                        build.unindex(full)
+                    else:
+                        build.index(full, entry)
+                    fresh.add(full)
+
+        except Exception:
+            return False
+        finally:
+            self.building = None
+
+        # research. Registrations of the entries where the data changed are dropped, and made again from
+        # the new data. The other entries are kept as they are
+        def refresh_entry(full):
+            entry = path_index.get(full)
+            if entry is not None and full not in fresh:
+                path_index[full] = PathCacheObject(val=entry.val, path=entry.path, ids=entry.ids, mask=entry.mask)
+            fresh.add(full)
+
+        self.building = build
+        try:
+            for path, old, new in ancestors:
+                refresh_entry(path or (None,))
+                self.__visit_index_model_instance(models.values(), path[:-1], path[-1] if path else None, new)
+
+            for path, old, new in merged_again:
+                for value in (old, new):
+                    if value is not _ABSENT:
+                        for p, v in _walk(value):
+                            refresh_entry(path + p)
+                if new is not _ABSENT:
+                    wrapper = {path[-1]: new}
+                    yield from iterutils.research_steps(
+                        wrapper,
+                        query=lambda p, k, v: v is not wrapper and self.__visit_index_model_instance(
+                            models.values(), path[:-1] + p, k, v))
+        finally:
+            self.building = None
+
+        self.__publish(build)
+        return True
 
 
 
 
     def research_models(self):
+        with self.lock:
+            iterutils.run_steps(self.__rebuild_steps(merge=False, base=self.snapshot))
+
 
-        plugins = iterutils.research(
-            self.data,
+    def __research_steps(self):
+
+        target = self.building
+        plugins = yield from iterutils.research_steps(
+            target.data,
             query=lambda p, k, v: flmd.PLUGIN_MODEL.validator(v))
 
         for p in plugins:
-            m = self.register_model(
-                p[1]['name'],
-                flmd.PLUGIN_MODEL.factory(p[1]),
-                False)
+            m = flmd.PLUGIN_MODEL.factory(p[1])
+            target.models[p[1]['name']] = m
             # Give self to the plugin model instances so, in turn, the models can provide to their instances
             if m.inject == 'flange':
                 m.fobj = self
 
-        iterutils.research(
-            self.data,
-            query=lambda p, k, v: self.__visit_index_model_instance(self.models.values(), p, k, v))
+        yield from iterutils.research_steps(
+            target.data,
+            query=lambda p, k, v: self.__visit_index_model_instance(target.models.values(), p, k, v))
+
+
+
+
+
+    #
+    #
+    #   Watch mode
+    #
+    #
+
+    def watch(self, on_change=None, latency=watch.DEFAULT_LATENCY):
+        """
+        Watch the directories walked during gather with inotify (Linux only) and apply file changes as
+        they happen. Created files matching the file patterns are added as sources, modified files are
+        reloaded and deleted files are dropped, then the sources are merged again.
+
+        :param on_change: optional func(cfg, paths) called after changes have been applied
+        :param latency: seconds without new events to wait before applying a burst of changes
+        :return: the Watcher
+        """
+        with self.lock:
+            self.on_change = on_change
+            if not self.watcher:
+                self.watcher = watch.Watcher(self.__apply_fs_changes, latency)
+                self.watcher.sync(self.walked_dirs)
+                self.watcher.start()
+            return self.watcher
+
+
+    def unwatch(self):
+        # the watcher thread may be waiting on the lock to apply a change, so it must be stopped
+        # after the lock is released. It finds self.watcher gone and drops the change
+        with self.lock:
+            watcher, self.watcher = self.watcher, None
+        if watcher:
+            watcher.stop(watch.STOP_TIMEOUT)
+
+
+    def __apply_fs_changes(self, paths, overflow):
+
+        with self.lock:
+
+            if not self.watcher:
+                return
+
+            if overflow:
+                # events were lost. start over
+                self.refresh(gather=True)
+
+            else:
+                file_patterns = discovery.PatternSet(self.file_patterns)
+                exclude_patterns = discovery.PatternSet(self.file_exclude_patterns)
+                changed = []
+
+                for path in sorted(paths):
+                    name = os.path.basename(path)
+                    parent_depth = self.walked_dirs.get(os.path.dirname(path))
+
+                    if os.path.isdir(path):
+                        if (path not in self.walked_dirs and parent_depth is not None
+                                and parent_depth < self.file_search_depth
+                                and not exclude_patterns.match(name) and not os.path.islink(path)):
+                            changed.extend(self.__add_dir(path, parent_depth + 1, file_patterns, exclude_patterns))
+
+                    elif os.path.exists(path):
+                        src = next((s for s in self.sources if isinstance(s, SourceFile) and s.uri == path), None)
+                        if src:
+                            src.load()
+                            changed.append(src)
+                        elif (parent_depth is not None and file_patterns.match(name)
+                              and not exclude_patterns.match(name)):
+                            changed.extend(self.__add_file_source(path))
+
+                    else:
+                        changed.extend(self.__drop_path(path))
+
+                if changed and not iterutils.run_steps(self.__remerge_steps(changed)):
+                    iterutils.run_steps(self.__rebuild_steps())
+
+        if self.on_change:
+            self.on_change(self, paths)
+
+
+    def __add_dir(self, path, depth, file_patterns, exclude_patterns):
+
+        walked = {}
+        added = []
+        for filename in discovery.find_files(path, file_patterns, exclude_patterns,
+                                             self.file_search_depth - depth, self.file_search_workers,
+                                             walked=walked):
+            added.extend(self.__add_file_source(filename))
+
+        for dir, d in walked.items():
+            self.walked_dirs[dir] = d + depth
+            if self.watcher:
+                self.watcher.add(dir)
+        return added
+
+
+    def __add_file_source(self, filename):
+
+        if filename in self.visited_uris:
+            return []
+
+        src = self.__new_file_source(filename)
+        src.load()
+        self.visited_uris.add(src.uri)
+
+        # insert where gather would have put it
+        tops = [os.path.realpath(os.path.expanduser(d)) for d in self.base_dir]
+        key = discovery.walk_order_key(tops, filename)
+        pos = 0
+        for i, s in enumerate(self.sources):
+            if not isinstance(s, SourceFile):
+                break
+            if key is not None and (discovery.walk_order_key(tops, s.uri) or ()) > key:
+                break
+            pos = i + 1
+        self.sources.insert(pos, src)
+        return [src]
+
 
+    def __drop_path(self, path):
 
+        # a deleted file or all files under a deleted directory
+        prefix = path + os.sep
+        dropped = [s for s in self.sources if isinstance(s, SourceFile) and (s.uri == path or s.uri.startswith(prefix))]
+        for s in dropped:
+            self.sources.remove(s)
+            self.visited_uris.discard(s.uri)
+
+        for dir in [d for d in self.walked_dirs if d == path or d.startswith(prefix)]:
+            del self.walked_dirs[dir]
+            if self.watcher:
+                self.watcher.remove(dir)
+
+        return dropped
 
 
 
@@ -363,10 +1343,24 @@ class Cfg(object):
        :param raise_absent: if True then raise exception if no match is found
        :return: list matching ojects directly from data/config in the form of ((k1, k2, .., kn), value)
        """
+        return self.__search(self.__snapshot_for(path), path, values, unique, raise_absent, vfunc)
+
+
+    def __snapshot_for(self, path):
+        # the snapshot to answer a search of path from. A reader takes it once so the data and index it
+        # reads are from the same refresh
+        if self.lazy:
+            self.__load_for_path(path)
+        return self.snapshot
+
+
+    def __search(self, snapshot, path, values, unique, raise_absent, vfunc):
+
         path_and_value_list = iterutils.search(
-                self.data,
+                snapshot.data,
                 path=path,
-                required_values=values)
+                required_values=values,
+                value_index=snapshot.value_index if self.index_values and values and not path else None)
 
         # print 'search found ', [x[0] for x in path_and_value_list]
 
@@ -399,19 +1393,23 @@ class Cfg(object):
 
 
     def src(self, path=None, values=None, raise_absent=False):
-        sources = self.search(path=path, values=values, unique=True, raise_absent=raise_absent, vfunc=lambda x: self.path_index[x[0]].srcs)
+        snapshot = self.__snapshot_for(path)
+        sources = self.__search(snapshot, path, values, True, raise_absent, lambda x: snapshot.path_index[x[0]].srcs)
         return next(iter(sources))
     def srcs(self, path=None, values=None, raise_absent=False):
-        sources = self.search(path=path, values=values, unique=False, raise_absent=raise_absent, vfunc=lambda x: self.path_index[x[0]].srcs)
+        snapshot = self.__snapshot_for(path)
+        sources = self.__search(snapshot, path, values, False, raise_absent, lambda x: snapshot.path_index[x[0]].srcs)
         return list(set([s for l in sources for s in l])) if sources else sources
 
 
 
     def uri(self, path=None, values=None, raise_absent=False):
-        sources = self.search(path=path, unique=True, values=values, raise_absent=raise_absent, vfunc=lambda x: self.path_index[x[0]].srcs)
+        snapshot = self.__snapshot_for(path)
+        sources = self.__search(snapshot, path, values, True, raise_absent, lambda x: snapshot.path_index[x[0]].srcs)
         return next(iter(sources)).uri
     def uris(self, path=None, values=None, raise_absent=False):
-        sources = self.search(path=path, unique=False, values=values, raise_absent=raise_absent, vfunc=lambda x: self.path_index[x[0]].srcs)
+        snapshot = self.__snapshot_for(path)
+        sources = self.__search(snapshot, path, values, False, raise_absent, lambda x: snapshot.path_index[x[0]].srcs)
         return [src.uri for l in sources for src in l] if sources else sources
 
 
@@ -424,8 +1422,10 @@ class Cfg(object):
        :param raise_absent: if True then raise exception if no match is found
        :return: matching object from cache if already created or new if not
        """
-        return self.search(path=path, unique=True, raise_absent=raise_absent, values=values,
-                            vfunc=lambda x: self.path_index[x[0]].instance(model=model) if x[0] in self.path_index else None)
+        snapshot = self.__snapshot_for(path)
+        index = snapshot.path_index
+        return self.__search(snapshot, path, values, True, raise_absent,
+                             lambda x: index[x[0]].instance(model=model) if x[0] in index else None)
     def objs(self, path=None, model=None, values=None, raise_absent=False):
         """
        Return list of model object instances matching given criteria
@@ -434,8 +1434,10 @@ class Cfg(object):
        :param raise_absent: if True then raise exception if no match is found
        :return: list of matching objects
        """
-        return self.search(path=path, unique=False, raise_absent=raise_absent, values=values,
-                       vfunc=lambda x: self.path_index[x[0]].instance(model=model, reraise=False) if x[0] in self.path_index else None)
+        snapshot = self.__snapshot_for(path)
+        index = snapshot.path_index
+        return self.__search(snapshot, path, values, False, raise_absent,
+                             lambda x: index[x[0]].instance(model=model, reraise=False) if x[0] in index else None)
 
 
     def value(self, path=None, values=None, raise_absent=False):
@@ -467,7 +1469,8 @@ class Cfg(object):
         :param raise_absent: if True then raise exception if no match is found
         :return: single model instance/registration object
         """
-        return self.path_index[self.search(path=path, unique=unique, values=values, raise_absent=raise_absent)[0]]
+        snapshot = self.__snapshot_for(path)
+        return snapshot.path_index[self.__search(snapshot, path, values, unique, raise_absent, lambda x: x)[0]]
 
     def fobjs(self, path=None, values=None, raise_absent=False):
         """
@@ -477,8 +1480,9 @@ class Cfg(object):
         :param raise_absent: if True then raise exception if no match is found
         :return: list of model instance/registration objects
         """
-        return self.search(path=path, unique=False, values=values, raise_absent=raise_absent,
-                           vfunc=lambda x: self.path_index[x[0]] if x[0] in self.path_index else None)
+        snapshot = self.__snapshot_for(path)
+        index = snapshot.path_index
+        return self.__search(snapshot, path, values, False, raise_absent, lambda x: index[x[0]] if x[0] in index else None)
 
 
 
@@ -496,15 +1500,29 @@ class Cfg(object):
     #         research)
 
     def register_model(self, name, model, research=True):
-        self.models[name] = model
-        if research:
-            iterutils.research(
-                self.data,
-                query=lambda p, k, v: self.__visit_index_model_instance([model], p, k, v))
+        with self.lock:
+            build = Build(self.snapshot)
+            build.models[name] = model
+            if research:
+                building, self.building = self.building, build
+                try:
+                    iterutils.research(
+                        build.data,
+                        query=lambda p, k, v: self.__visit_index_model_instance([model], p, k, v))
+                finally:
+                    self.building = building
+            self.__publish(build)
         return model
 
 
-    def __filter_and_index(self, src, p, k, v):
+    def __index_path(self, src, p, k, v, journal=None, full_path=None):
+        """
+        Apply the key filter and index the path p + (k,) if the key passes
+
+        :param journal: optional list to record changes to the index in, see __unindex
+        :param full_path: p + (k,) if the caller has it already
+        :return: False if the key was filtered out
+        """
 
         # now the root_path/ns has already been accounted for in the data.
         # no prefixing loginc
@@ -516,22 +1534,141 @@ class Cfg(object):
         # filter. func may be provided or be class default
         if self.key_filter and not self.key_filter(np, k, v):
             # print 'filtered out ', np, k
-            return v, False
+            return False
 
         # index. internal to Cfg class
-        full_path = np + (k,)
-        if full_path in self.path_index:
+        path_index = self.building.path_index
+        if full_path is None:
+            full_path = np + (k,)
+        if full_path in path_index:
             # print 'preexisting index at ', full_path
-            if not self.path_index[full_path].val_equals(v):
+            if not path_index[full_path].val_equals(v) and not path_index[full_path].has_src(src):
                 # print 'updating index at ', full_path
                 # raise ValueError('unexpected value change at path_index[{}]'.format(full_path))
-                self.path_index[full_path].add_src(src)
+                if journal is not None:
+                    journal.append((full_path, False))
+                self.building.entry(full_path).add_src(src)
         else:
             # print 'adding index at ', full_path
-            self.path_index[full_path] = PathCacheObject(val=v, path=full_path, srcs=set([src]))
+            self.building.index(full_path, PathCacheObject(val=v, path=full_path, ids=self.source_ids,
+                                                           mask=self.source_ids.mask(src)))
+            if journal is not None:
+                journal.append((full_path, True))
+
+        return True
+
+
+    def __unindex(self, src, journal):
+        # undo the changes to the index recorded in journal by __index_path
+        for full_path, created in reversed(journal):
+            if created:
+                self.building.unindex(full_path)
+            else:
+                self.building.entry(full_path).discard_src(src)
+
 
+    def __build_steps(self, src, events, index=True):
+        """
+        Build the tree of a source from its events in one pass. Compound keys are expanded as nodes are
+        placed, each placed node is recorded, and once the tree is complete the key filter and index are
+        applied to the recorded nodes in order. This replaces the unflatten and key filter remaps, each of
+        which made a full copy of the source. The key filter and index see each collection complete.
+
+        A generator of steps like remap_steps. The return value is the tree to merge
 
-        return iterutils.default_enter(p, k, v)
+        :param events: iterator of source events. See SourceFileStream.events
+        :param index: if False the tree is only built
+        """
+        separator = self.unflatten_separator
+        tree = {}
+        # (collection, path, key, value, position of the parent entry, path of the node) of each placed
+        # node. The parent is None for the top and DROPPED below a key unflatten drops. The path of the
+        # node is built once, for its children and as its index key
+        entries = [(None, (), None, tree, None, (None,))]
+
+        def place(frame, key, value):
+            # put value at key in the collection of frame. return the frame for the value
+            container, path, parent = frame
+            if isinstance(container, list):
+                container.append(value)
+                full = path + (key,)
+                entries.append((container, path, key, value, parent, full))
+                return value, full, len(entries) - 1
+
+            segments = iterutils.split_key(key, separator) if separator else [key]
+            if not segments:
+                # unflatten drops the key. still parsed, but not kept or indexed
+                return value, (), DROPPED
+
+            for i, segment in enumerate(segments):
+                if type(segment) is str:
+                    # one string per distinct key, shared by the trees, the merged data and the index paths
+                    segment = intern(segment)
+                node = container.get(segment)
+                if not (isinstance(node, dict) and (i < len(segments) - 1 or isinstance(value, dict))):
+                    node = value if i == len(segments) - 1 else {}
+                    container[segment] = node
+                # else merge into the mapping an earlier key put here
+                full = path + (segment,)
+                entries.append((container, path, segment, node, parent, full))
+                container, path, parent = node, full, len(entries) - 1
+            return container, path, parent
+
+        top = (tree, (), 0)
+        frames = []
+        found = False
+        countdown = iterutils.REMAP_STEP_ITEMS
+        for event, key, value in events:
+            countdown -= 1
+            if not countdown:
+                countdown = iterutils.REMAP_STEP_ITEMS
+                yield
+
+            if event == flsrc.END:
+                frames.pop()
+                continue
+
+            if frames:
+                frame = place(frames[-1], key, value)
+            else:
+                if found:
+                    raise ValueError('{} has more than one top level value'.format(src.uri))
+                found = True
+                if src.root_path:
+                    frame = place(top, src.root_path, value)
+                elif isinstance(value, dict):
+                    frame = top
+                else:
+                    raise ValueError('{} is not a mapping'.format(src.uri))
+
+            if event == flsrc.START:
+                frames.append(frame)
+
+        if not found and src.root_path:
+            # empty document
+            place(top, src.root_path, {})
+        if not index:
+            return tree
+
+        # filter and index. A node is only indexed if its parent was and it is still in the tree, not
+        # replaced by a later key of the source. The index is only changed once the tree is complete,
+        # and the changes are undone if the key filter raises
+        journal = []
+        indexed = []
+        try:
+            for container, path, key, value, parent, full in entries:
+                countdown -= 1
+                if not countdown:
+                    countdown = iterutils.REMAP_STEP_ITEMS
+                    yield
+                indexed.append((parent is None or (parent >= 0 and indexed[parent]
+                                                   and (isinstance(container, list) or container.get(key) is value)))
+                               and self.__index_path(src, path, key, value, journal, full))
+        except Exception:
+            self.__unindex(src, journal)
+            raise
+
+        return tree
 
 
     def __visit_index_model_instance(self, models, p, k, v):
@@ -540,61 +1677,69 @@ class Cfg(object):
         """
             # print 'model visit {} on {}'.format(model, v)
         cp = p + (k,)
+        path_index = self.building.path_index
         for model in models:
             try:
                 if model.validator(v):
-                    if cp in self.path_index:
-                        # if self.path_index[cp].val != v:
+                    if cp in path_index:
+                        # if path_index[cp].val != v:
                         #     raise ValueError('unexpected value change at path_index[{}]'.format(cp))
-                        self.path_index[cp].add_model(model, v)
+                        if model.name not in path_index[cp].mregs:
+                            self.building.entry(cp).add_model(model, v)
                     else:
                         # The object should already be in the index but don't complain for now.
-                        self.path_index[cp] = PathCacheObject(val=v, path=cp, regs=[model])
+                        self.building.index(cp, PathCacheObject(val=v, path=cp, regs=[model]))
             except:
                 pass
 
 
 
-    def __get_file_sources(self, topdir):
+    def __new_file_source(self, filename):
+
+        root_path = self.root_path(filename) if callable(self.root_path) else self.root_path
+        if self.stream_file_size is not None:
+            parser = flsrc.PARSABLE_EXTENSIONS.get(os.path.splitext(filename)[1][1:])
+            try:
+                if parser in flsrc.STREAMABLE_PARSABLES and os.path.getsize(filename) >= self.stream_file_size:
+                    return SourceFileStream(filename, root_path)
+            except OSError:
+                # the load will record the error
+                pass
+
+        return SourceFile(filename, root_path, max_size=self.max_file_size, cache=self.parse_cache)
+
+
+
+    def __get_file_sources(self, topdirs):
+
+        # compile the patterns once for directory pruning and file selection
+        file_patterns = discovery.PatternSet(self.file_patterns)
+        exclude_patterns = discovery.PatternSet(self.file_exclude_patterns)
+
+        manifest = None
+        if self.discovery_manifest:
+            manifest = discovery.Manifest(self.discovery_manifest, file_patterns, exclude_patterns)
 
         sources = []
-        topdir = os.path.realpath(os.path.expanduser(topdir))
-        start_depth = topdir.count(os.sep)
-
-        # print '__get_file_sources on ', dir
-        for root, dirnames, filenames in os.walk(os.path.realpath(os.path.expanduser(topdir)), topdown=True):
-
-            # print 'walk: {}. {}. {}'.format(root, dirnames, filenames)
-
-            depth = root.count(os.sep) - self.base_dir.count(os.sep) - start_depth
-            if depth >= self.file_search_depth:
-                # print 'depth {} exceeded {} on {}'.format(depth, self.file_search_depth, root)
-                del dirnames[:]
-
-
-            # remove excluded directories and files
-            for e in self.file_exclude_patterns:
-                for d in [dirname for dirname in fnmatch.filter(dirnames, e)]:
-                    dirnames.remove(d)
-                for f in [filename for filename in fnmatch.filter(filenames, e)]:
-                    # print 'removing ', f
-                    filenames.remove(f)
-
-            to_include = set()
-            for p in self.file_patterns:
-                for filename in fnmatch.filter(filenames, p):
-                    to_include.add(os.path.join(root, filename))
-
-            for filename in to_include:
-                # print filename
-                # Don't add a uri twice
-                # print '{} is in {}: {}'.format(filename,  self.visited_uris, filename in self.visited_uris)
-                if filename not in self.visited_uris:
-
-                    src = SourceFile(filename, self.root_path)
-                    if src:
-                        sources.append(src)
-                        self.visited_uris.add(src.uri)
+        for filename in discovery.find_files(
+                topdirs,
+                file_patterns,
+                exclude_patterns,
+                self.file_search_depth,
+                self.file_search_workers,
+                manifest,
+                self.walked_dirs):
+
+            # Don't add a uri twice
+            if filename not in self.visited_uris:
+
+                src = self.__new_file_source(filename)
+                if src:
+                    sources.append(src)
+                    self.visited_uris.add(src.uri)
+
+        if manifest:
+            manifest.save()
 
         return sources
 
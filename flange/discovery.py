@@ -0,0 +1,274 @@
+import os, re, fnmatch, json, time
+from concurrent.futures import ThreadPoolExecutor
+
+
+DEFAULT_DISCOVERY_WORKERS = 8
+
+# A directory listing is only trusted if the directory mtime is older than the listing by at least
+# this much. Otherwise a change made within the filesystem timestamp granularity could be missed.
+MANIFEST_RACY_NS = 2 * 10**9
+MANIFEST_VERSION = 1
+
+
+
+class PatternSet(object):
+    """
+    A set of glob patterns compiled to a single matcher. Patterns without wildcards are looked up in
+    a set, patterns that are a '*' followed by a literal (like '*.yml') are checked with a single
+    str.endswith call, and the rest are joined into one regular expression. Matching follows
+    fnmatch.fnmatch, including case folding on platforms where os.path.normcase folds case.
+    """
+
+    MAGIC = re.compile('[*?[]')
+
+    def __init__(self, patterns=None):
+        self.patterns = list(patterns or [])
+
+        literals = set()
+        suffixes = []
+        regexes = []
+        for p in self.patterns:
+            p = os.path.normcase(p)
+            if not self.MAGIC.search(p):
+                literals.add(p)
+            elif p.startswith('*') and not self.MAGIC.search(p, 1):
+                suffixes.append(p[1:])
+            else:
+                regexes.append(fnmatch.translate(p))
+
+        self.literals = literals
+        self.suffixes = tuple(suffixes)
+        self.regex = re.compile('|'.join(regexes)).match if regexes else None
+
+
+    @staticmethod
+    def of(patterns):
+        return patterns if isinstance(patterns, PatternSet) else PatternSet(patterns)
+
+
+    def __repr__(self):
+        return '<PatternSet {}>'.format(self.patterns)
+
+    def __bool__(self):
+        return bool(self.patterns)
+
+
+    def match(self, name):
+        name = os.path.normcase(name)
+        return (name in self.literals
+                or (self.suffixes and name.endswith(self.suffixes))
+                or (self.regex is not None and self.regex(name) is not None))
+
+
+
+def classify_dir(path, file_patterns, exclude_patterns):
+    """
+    List a directory and apply the include and exclude patterns in a single pass over its entries
+
+    :param file_patterns: PatternSet or list of glob patterns a filename must match to be included
+    :param exclude_patterns: PatternSet or list of glob patterns of directories and files to skip
+    :return: (filenames, subdirs) of included filenames and names of subdirectories to walk, both sorted
+    """
+    file_patterns = PatternSet.of(file_patterns)
+    exclude_patterns = PatternSet.of(exclude_patterns)
+
+    filenames = []
+    subdirs = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                name = entry.name
+                if exclude_patterns.match(name):
+                    continue
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    try:
+                        if not entry.is_symlink():
+                            subdirs.append(name)
+                    except OSError:
+                        pass
+                elif file_patterns.match(name):
+                    filenames.append(name)
+    except OSError:
+        pass
+
+    filenames.sort()
+    subdirs.sort()
+    return filenames, subdirs
+
+
+
+class Manifest(object):
+    """
+    On-disk record of discovered files keyed by directory mtime. A directory is only listed again if
+    its mtime has changed since it was recorded, otherwise the recorded files and subdirectories are
+    reused. Adding, removing or renaming an entry changes the mtime of the containing directory.
+
+    The manifest is only valid for the patterns it was created with. A manifest written with other
+    patterns is discarded on load. Writes are atomic so the file may be shared by many processes.
+    """
+
+    def __init__(self, path, file_patterns, exclude_patterns=None):
+        self.path = os.path.expanduser(path)
+        self.key = [PatternSet.of(file_patterns).patterns, PatternSet.of(exclude_patterns).patterns]
+        self.dirs = {}
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                m = json.load(f)
+            if m.get('version') == MANIFEST_VERSION and m.get('key') == self.key:
+                self.dirs = m['dirs']
+        except (OSError, ValueError, KeyError, AttributeError):
+            self.dirs = {}
+
+
+    def save(self):
+        if not self.dirty:
+            return
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'version': MANIFEST_VERSION, 'key': self.key, 'dirs': self.dirs}, f)
+            os.replace(tmp, self.path)
+            self.dirty = False
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+
+    def classify(self, path, file_patterns, exclude_patterns):
+        """
+        Same as classify_dir but answered from the manifest if the directory is unchanged
+        """
+        started = int(time.time() * 1e9)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            if self.dirs.pop(path, None):
+                self.dirty = True
+            return [], []
+
+        entry = self.dirs.get(path)
+        if entry and entry[0] == mtime:
+            self.hits += 1
+            return entry[1], entry[2]
+
+        self.misses += 1
+        filenames, subdirs = classify_dir(path, file_patterns, exclude_patterns)
+        if mtime + MANIFEST_RACY_NS <= started:
+            self.dirs[path] = [mtime, filenames, subdirs]
+        else:
+            self.dirs.pop(path, None)
+        self.dirty = True
+        return filenames, subdirs
+
+
+
+def find_files(topdirs, file_patterns, exclude_patterns=None, search_depth=0, workers=DEFAULT_DISCOVERY_WORKERS,
+               manifest=None, walked=None):
+    """
+    Find files under one or more top directories. Directories are listed level by level, with all
+    directories of a level, across all top directories, listed at once on a thread pool.
+
+    The returned order is deterministic: top directories in the order given, and within each a
+    pre-order walk where the files of a directory (sorted by name) come before its subdirectories
+    (also sorted by name). A file reachable from more than one top directory is returned once.
+
+    :param topdirs: directory or list of directories. '~' is expanded
+    :param file_patterns: PatternSet or list of glob patterns a filename must match to be included
+    :param exclude_patterns: PatternSet or list of glob patterns of directories and files to skip
+    :param search_depth: number of directory levels below each top directory to descend
+    :param workers: max number of threads used to list directories
+    :param manifest: optional Manifest used to skip listing directories that have not changed
+    :param walked: optional dict that is updated with the depth of each directory walked
+    :return: list of file paths
+    """
+    if isinstance(topdirs, str):
+        topdirs = [topdirs]
+    file_patterns = PatternSet.of(file_patterns)
+    exclude_patterns = PatternSet.of(exclude_patterns)
+    tops = [os.path.realpath(os.path.expanduser(d)) for d in topdirs]
+
+    classify = manifest.classify if manifest else classify_dir
+    scan = lambda d: classify(d, file_patterns, exclude_patterns)
+
+    # (dir, depth) -> (included filenames, subdirectories to walk)
+    listings = {}
+    classified = {}
+    level = [(top, 0) for top in tops]
+    pool = None
+
+    try:
+        while level:
+
+            to_scan = [d for d in set(d for d, depth in level) if d not in classified]
+            if len(to_scan) > 1 and workers and workers > 1:
+                if not pool:
+                    pool = ThreadPoolExecutor(max_workers=workers)
+                classified.update(zip(to_scan, pool.map(scan, to_scan)))
+            else:
+                classified.update((d, scan(d)) for d in to_scan)
+
+            next_level = []
+            for dir, depth in level:
+                if (dir, depth) in listings:
+                    continue
+
+                filenames, subdirs = classified[dir]
+                subdirs = [os.path.join(dir, d) for d in subdirs] if depth < search_depth else []
+
+                listings[(dir, depth)] = (filenames, subdirs)
+                if walked is not None and depth < walked.get(dir, depth + 1):
+                    walked[dir] = depth
+                next_level.extend((s, depth + 1) for s in subdirs)
+
+            level = next_level
+    finally:
+        if pool:
+            pool.shutdown()
+
+
+    # assemble the results in walk order
+    found = []
+    seen = set()
+    for top in tops:
+        stack = [(top, 0)]
+        while stack:
+            dir, depth = stack.pop()
+            filenames, subdirs = listings[(dir, depth)]
+            for f in filenames:
+                path = os.path.join(dir, f)
+                if path not in seen:
+                    seen.add(path)
+                    found.append(path)
+            stack.extend((s, depth + 1) for s in reversed(subdirs))
+
+    return found
+
+
+
+def walk_order_key(topdirs, path):
+    """
+    Sort key that orders a path the way find_files would have returned it
+
+    :param topdirs: the (real) top directories given to find_files
+    :param path: path of a file found under one of topdirs
+    :return: sort key or None if path is not under any of topdirs
+    """
+    for i, top in enumerate(topdirs):
+        rel = os.path.relpath(path, top)
+        if rel == os.curdir or rel.startswith(os.pardir + os.sep) or rel == os.pardir:
+            continue
+        parts = rel.split(os.sep)
+        return (i,) + tuple((1, d) for d in parts[:-1]) + ((0, parts[-1]),)
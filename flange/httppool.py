@@ -0,0 +1,109 @@
+import threading
+import http.client
+import urllib.parse
+
+
+DEFAULT_HTTP_TIMEOUT = 10.0
+
+# idle keep-alive connections kept per host
+DEFAULT_MAX_IDLE = 4
+
+# a reused connection that the server closed while it was idle fails with one of these on first use
+STALE_ERRORS = (http.client.RemoteDisconnected, http.client.BadStatusLine, ConnectionResetError,
+                BrokenPipeError, ConnectionAbortedError)
+
+
+
+class ConnectionPool(object):
+    """
+    Keep-alive http.client connections shared by all http sources and kept per (scheme, host, port).
+    A connection is returned to the pool once its response has been read, unless the server asked to
+    close it. Thread safe.
+    """
+
+    def __init__(self, max_idle=DEFAULT_MAX_IDLE):
+        """
+        :param max_idle: max idle connections kept per host. Extra connections are closed when released
+        """
+        self.max_idle = max_idle
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.created = 0
+
+
+    def __repr__(self):
+        return '<ConnectionPool #hosts={} created={}>'.format(len(self.idle), self.created)
+
+
+    def _acquire(self, key, timeout):
+        with self.lock:
+            conns = self.idle.get(key)
+            conn = conns.pop() if conns else None
+        if conn:
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            return conn, True
+
+        scheme, host, port = key
+        cls = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        with self.lock:
+            self.created += 1
+        return cls(host, port, timeout=timeout), False
+
+
+    def _release(self, key, conn):
+        with self.lock:
+            conns = self.idle.setdefault(key, [])
+            if len(conns) < self.max_idle:
+                conns.append(conn)
+                return
+        conn.close()
+
+
+    def request(self, url, headers=None, timeout=DEFAULT_HTTP_TIMEOUT):
+        """
+        GET url on a pooled connection. A reused connection the server has since closed is replaced and
+        the request sent again.
+
+        :return: (status, headers as a http.client.HTTPMessage, body bytes)
+        """
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError('not an http url: {}'.format(url))
+        key = (parts.scheme, parts.hostname, parts.port)
+        target = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+
+        while True:
+            conn, reused = self._acquire(key, timeout)
+            try:
+                conn.request('GET', target, headers=headers or {})
+                response = conn.getresponse()
+                body = response.read()
+            except STALE_ERRORS:
+                conn.close()
+                if reused:
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+
+            if response.will_close:
+                conn.close()
+            else:
+                self._release(key, conn)
+            return response.status, response.headers, body
+
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+
+# used by http sources unless given another
+POOL = ConnectionPool()
@@ -46,6 +46,7 @@ following are based on examples in itertools docs.
 """
 
 import os
+import re
 import math
 import time
 import codecs
@@ -54,10 +55,14 @@ import socket
 import hashlib
 import itertools
 
+from array import array
 from collections.abc import Mapping, Sequence, Set, ItemsView
 
 import dpath.util
 
+# a segment of a dpath glob that is a pattern rather than a key
+_GLOB_MAGIC = re.compile('[*?[]')
+
 
 try:
     from typeutils import make_sentinel
@@ -877,6 +882,31 @@ def remap(root, visit=default_visit, enter=default_enter, exit=default_exit,
     """
     # TODO: improve argument formatting in sphinx doc
     # TODO: enter() return (False, items) to continue traverse but cancel copy?
+    return run_steps(remap_steps(root, visit, enter, exit, **kwargs))
+
+
+# number of items remap_steps handles between steps
+REMAP_STEP_ITEMS = 100
+
+
+def run_steps(steps):
+    """Run a generator of steps, like :func:`remap_steps`, to the end and
+    return its return value.
+    """
+    try:
+        while True:
+            next(steps)
+    except StopIteration as e:
+        return e.value
+
+
+def remap_steps(root, visit=default_visit, enter=default_enter, exit=default_exit,
+                **kwargs):
+    """Same as :func:`remap` but as a generator that yields None after
+    every *step_items* (default REMAP_STEP_ITEMS) items so a long
+    traversal can be interleaved with other work. The remapped object is
+    the return value of the generator. See :func:`run_steps`.
+    """
     if not callable(visit):
         raise TypeError('visit expected callable, not: %r' % visit)
     if not callable(enter):
@@ -884,12 +914,18 @@ def remap(root, visit=default_visit, enter=default_enter, exit=default_exit,
     if not callable(exit):
         raise TypeError('exit expected callable, not: %r' % exit)
     reraise_visit = kwargs.pop('reraise_visit', True)
+    step_items = kwargs.pop('step_items', REMAP_STEP_ITEMS)
     if kwargs:
         raise TypeError('unexpected keyword arguments: %r' % kwargs.keys())
 
     path, registry, stack = (), {}, [(None, root)]
     new_items_stack = []
+    countdown = step_items
     while stack:
+        countdown -= 1
+        if not countdown:
+            countdown = step_items
+            yield
         key, value = stack.pop()
         id_value = id(value)
         if key is _REMAP_EXIT:
@@ -1065,6 +1101,13 @@ def research(root, query=lambda p, k, v: True, reraise=False):
 
     .. _submitting a patch: https://github.com/mahmoud/boltons/pulls
     """
+    return run_steps(research_steps(root, query, reraise))
+
+
+def research_steps(root, query=lambda p, k, v: True, reraise=False):
+    """Same as :func:`research` as a generator of steps. The results are
+    the return value of the generator. See :func:`remap_steps`.
+    """
     ret = []
 
     if not callable(query):
@@ -1079,7 +1122,7 @@ def research(root, query=lambda p, k, v: True, reraise=False):
                 raise
         return default_enter(path, key, value)
 
-    remap(root, enter=enter)
+    yield from remap_steps(root, enter=enter)
     return ret
 
 
@@ -1259,6 +1302,64 @@ import anyconfig
 
 
 
+def merge_steps(target, other, step_items=REMAP_STEP_ITEMS, owned=None):
+    '''
+    Same as anyconfig.merge(target, other) with the default (MS_DICTS) strategy as a generator that
+    yields None after every step_items keys. Mappings are merged recursively and anything else
+    replaces the value in target
+
+    :param target: dict that is updated in place
+    :param other: dict to merge into target
+    :param owned: optional set of the ids of the mappings in target that may be changed. Any other
+    mapping is copied before anything is merged into it, and the copy added to owned
+    '''
+    stack = [(target, other)]
+    countdown = step_items
+    while stack:
+        current, update = stack.pop()
+        if not isinstance(update, dict):
+            # a list of pairs or an error. let anyconfig decide
+            anyconfig.merge(current, update)
+            continue
+        for key, val in update.items():
+            countdown -= 1
+            if not countdown:
+                countdown = step_items
+                yield
+            node = current.get(key)
+            if isinstance(node, Mapping):
+                if owned is not None and id(node) not in owned:
+                    node = current[key] = node.copy() if hasattr(node, 'copy') else dict(node)
+                    owned.add(id(node))
+                stack.append((node, val))
+            else:
+                current[key] = val
+
+
+
+def merge_all_steps(trees, step_items=REMAP_STEP_ITEMS):
+    '''
+    Merge a list of dicts, later ones taking precedence, into a new dict with merge_steps. Shared
+    subtrees are walked once per tree that has them, never again for trees merged before. A tree that
+    fails part way stays partly merged, as with anyconfig.merge, and the rest are still merged.
+
+    The trees are not changed. The merged dict shares the subtrees only one tree has, and a mapping
+    more than one tree contributes to is copied from the first before the others are merged into it
+
+    :return: (merged dict, list of the trees that failed to merge)
+    '''
+    merged = {}
+    owned = set([id(merged)])
+    failed = []
+    for tree in trees:
+        try:
+            yield from merge_steps(merged, tree, step_items, owned)
+        except Exception:
+            failed.append(tree)
+    return merged, failed
+
+
+
 def unflatten(data, separator='.', replace=True):
     '''
     Expand all compound keys (at any depth) into nested dicts
@@ -1271,27 +1372,120 @@ def unflatten(data, separator='.', replace=True):
     :param separator: separator in compound keys
     :param replace: if true, remove the compound key. Otherwise the value will
     exist under the compound and expanded key
-    :return: copy of input dict with expanded keys
+    :return: input dict with expanded keys. Containers with nothing to expand, at or below them, are
+    the input's own. The rest are copies
+    '''
+    return run_steps(unflatten_steps(data, separator, replace))
+
+
+
+def unflatten_steps(data, separator='.', replace=True, step_items=REMAP_STEP_ITEMS):
+    '''
+    Same as unflatten as a generator of steps. See remap_steps. Containers are expanded children first.
+    A dict is checked for keys to expand in one scan of its keys and kept as is if it has none and
+    none of its values changed. Otherwise the expanded keys are spliced into a copy, merging into the
+    mappings earlier keys put there, the way Cfg builds a source
     '''
     if not separator:
         return data
-    return remap({'temp':data}, visit=lambda p, k, v: __expand_keys(k, v, separator, replace))['temp']
 
+    def plain(key):
+        # a key split_key leaves as it is
+        return key and (not isinstance(key, str) or not (separator in key or '.' in key or '/' in key))
 
+    def children(values):
+        # (position, value) of the values that are containers
+        return ((i, v) for i, v in enumerate(values) if isinstance(v, (dict, list)))
+
+    # [container, iterator of its children, [(position, changed value)] or None, position in its parent]
+    frames = [[None, children((data,)), None, 0]]
+    countdown = step_items
+    while True:
+        frame = frames[-1]
+        child = next(frame[1], None)
+        if child is not None:
+            value = child[1]
+            countdown -= len(value) + 1
+            if countdown <= 0:
+                countdown = step_items
+                yield
+            frames.append([value, children(value.values() if isinstance(value, dict) else value), None, child[0]])
+            continue
+
+        container, _, changed, position = frames.pop()
+        if container is None:
+            return changed[0][1] if changed else data
+
+        expanded = container
+        if isinstance(container, list):
+            if changed:
+                expanded = list(container)
+                for i, v in changed:
+                    expanded[i] = v
+        else:
+            to_expand = not all(plain(k) for k in container)
+            if changed or to_expand:
+                expanded = container.copy()
+                if changed:
+                    keys = list(container)
+                    for i, v in changed:
+                        expanded[keys[i]] = v
+                if to_expand:
+                    items = list(expanded.items())
+                    if replace:
+                        expanded.clear()
+                    owned = set([id(expanded)])
+                    for k, v in items:
+                        if replace or not plain(k):
+                            _splice(expanded, split_key(k, separator), v, owned)
+
+        if expanded is not container:
+            frame = frames[-1]
+            if frame[2] is None:
+                frame[2] = []
+            frame[2].append((position, expanded))
+
+
+
+def _splice(target, segments, value, owned):
+    # put value at the nested path of segments in target. A mapping an earlier key put on the way is
+    # merged into, after copying it if not in owned
+    last = len(segments) - 1
+    for i, segment in enumerate(segments):
+        node = target.get(segment)
+        if isinstance(node, dict) and (i < last or isinstance(value, dict)):
+            if id(node) not in owned:
+                node = target[segment] = node.copy()
+                owned.add(id(node))
+            if i == last:
+                for k, v in value.items():
+                    _splice(node, [k], v, owned)
+        elif i < last:
+            node = target[segment] = {}
+            owned.add(id(node))
+        else:
+            target[segment] = value
+        target = node
 
-def __expand_keys(k, v, separator, replace):
-    if isinstance(v, dict):
-        newvalue = v.copy()
-        for dkey, dvalue in v.items():
-            if replace:
-                del newvalue[dkey]
-            anyconfig.set_(
-                newvalue,
-                dkey.replace(separator, '.') if dkey else dkey,
-                dvalue)
 
-        return k, newvalue
-    return k, v
+
+def split_key(key, separator='.'):
+    '''
+    Segments of the nested path a key is expanded to by unflatten. The separator is replaced by '.',
+    then the key is split on '/' if it has one and on '.' otherwise. Falsy keys expand to nothing.
+
+    :return: list of path segments
+    '''
+    if not key:
+        return []
+    if not isinstance(key, str):
+        return [key]
+    key = key.replace(separator, '.')
+    for sep in ('/', '.'):
+        if sep in key:
+            return [''] if key == sep else [x for x in key.split(sep) if x]
+    return [key]
+
 
 
 def __query(p, k, v, accepted_keys=None, required_values=None, path=None, exact=True):
@@ -1340,7 +1534,159 @@ def __query(p, k, v, accepted_keys=None, required_values=None, path=None, exact=
     return True
 
 
-def search(data, path=None, required_values=None, exact=False):
+def _query_values(v, required_values, exact):
+    # the test search makes of each value when given required_values and no path
+    return __query(None, None, v, required_values=required_values, exact=exact)
+
+
+
+class ValueIndex(object):
+    """
+    Inverted index of the values in data, for searches by required values without a path. Those test
+    every node of data, the way research visits them. The index instead gives the nodes that could
+    pass a term: the str leaves that hold it and their parents, the grandparents of the leaves equal to
+    it, since a list can hold it, and the parents of the mappings that have it as a key. Only those are
+    tested, the same way, so the matches and their order are the same as research's.
+
+    A str term is found in the distinct str leaves by substring, so a term is looked for once per
+    distinct string instead of once per node. Terms that aren't str are left to research
+    """
+
+    def __init__(self, data):
+        # each node in research order: its value, its key and the position of its parent
+        self.values = [data]
+        self.keys = [None]
+        self.parents = array('l', [-1])
+        # str leaf -> positions of the nodes holding it
+        self.strings = {}
+        # str key -> positions of the mappings that have it
+        self.mapping_keys = {}
+        # (position, value) of containers under a node that research skipped, having been there already
+        self.repeated = []
+
+        values, keys, parents = self.values, self.keys, self.parents
+        registry = set()
+        stack = []
+
+        def enter(position, value):
+            new_parent, items = default_enter(None, None, value)
+            if items is not False:
+                registry.add(id(value))
+                if isinstance(value, Mapping):
+                    for key in value:
+                        if isinstance(key, str):
+                            self.mapping_keys.setdefault(key, array('l')).append(position)
+                stack.append((position, iter(items)))
+
+        enter(0, data)
+        # research refuses data it can't enter
+        self.remappable = bool(stack)
+        while stack:
+            parent, items = stack[-1]
+            item = next(items, _UNSET)
+            if item is _UNSET:
+                stack.pop()
+                continue
+            key, value = item
+            if id(value) in registry:
+                self.repeated.append((parent, value))
+                continue
+            position = len(values)
+            values.append(value)
+            keys.append(key)
+            parents.append(parent)
+            if isinstance(value, str):
+                self.strings.setdefault(value, array('l')).append(position)
+            else:
+                enter(position, value)
+
+    def __repr__(self):
+        return '<ValueIndex #nodes={} #strings={}>'.format(len(self.values), len(self.strings))
+
+
+    def path(self, position):
+        """
+        :return: path of the node at position, as research gives it
+        """
+        if not position:
+            return (None,)
+        path = []
+        while position:
+            path.append(self.keys[position])
+            position = self.parents[position]
+        return tuple(reversed(path))
+
+
+    def search(self, required_values, exact=False):
+        """
+        :return: list of (path, value) of the nodes with required_values, as research with the query of
+        search would find them. None if a term isn't str, or research would refuse the data
+        """
+        terms = [required_values] if isinstance(required_values, str) else list(required_values)
+        if not self.remappable or not all(isinstance(term, str) for term in terms):
+            return None
+
+        parents = self.parents
+        candidates = set()
+        for term in terms:
+            found = [(s, s == term) for s in self.strings if term in s] if not exact else \
+                [(term, True)] if term in self.strings else []
+            for s, equal in found:
+                for position in self.strings[s]:
+                    parent = parents[position]
+                    candidates.add(position)
+                    candidates.add(parent)
+                    if equal and parent >= 0:
+                        candidates.add(parents[parent])
+            for position in self.mapping_keys.get(term, ()):
+                candidates.add(parents[position])
+            for position, value in self.repeated:
+                try:
+                    if term in value:
+                        candidates.add(position)
+                except Exception:
+                    pass
+        candidates.discard(-1)
+
+        matches = []
+        for position in sorted(candidates):
+            value = self.values[position]
+            try:
+                if _query_values(value, required_values, exact):
+                    matches.append((self.path(position), value))
+            except Exception:
+                pass
+        return matches
+
+
+
+def _search_view(data, path):
+    """
+    The part of data a dpath search of path can match in. Below each leading segment of path that is
+    a key rather than a pattern, only the keys equal to it are kept, and keys that aren't str, which
+    dpath matches by their str. Searching the view finds what searching data does, in the same order,
+    without walking all of data
+    """
+    segments = path.lstrip('/').split('/')
+    if segments.count('**') > 1:
+        # dpath rejects the glob when it first matches a path with it. Leave it every path to try
+        return data
+    keys = []
+    for segment in segments:
+        if segment == '**' or _GLOB_MAGIC.search(segment):
+            break
+        keys.append(segment)
+
+    def view(node, depth):
+        if depth == len(keys) or not isinstance(node, dict):
+            return node
+        key = keys[depth]
+        return dict((k, view(v, depth + 1)) for k, v in node.items() if k == key or type(k) is not str)
+
+    return view(data, 0)
+
+
+def search(data, path=None, required_values=None, exact=False, value_index=None):
     '''
 
     :param data:
@@ -1349,19 +1695,23 @@ def search(data, path=None, required_values=None, exact=False):
     :param keys: match against keys
     :param values: match against values
     :param path: tuple or dpath expression representing the hierarchy/chain of parent keys
+    :param value_index: optional ValueIndex of data to search required_values in when there is no path
     :return: list of matches in the form ((path nesting sequence), value)
     '''
 
     # def has_required_values()
     if not path:
-        matches = research(
-            data,
-            query=lambda p, k, v: __query(p, k, v, required_values=required_values, path=path, exact=exact),
-            reraise=False)
+        matches = value_index.search(required_values, exact) if value_index is not None and required_values else None
+        if matches is None:
+            matches = research(
+                data,
+                query=lambda p, k, v: __query(p, k, v, required_values=required_values, path=path, exact=exact),
+                reraise=False)
     else:
         if isinstance(path, tuple):
             path = '/'.join(path)
-        matches = [(tuple(x[0].split('/')), x[1],) for x in dpath.util.search(data, path, yielded=True) if x[0]]
+        matches = [(tuple(x[0].split('/')), x[1],) for x in dpath.util.search(_search_view(data, path), path, yielded=True)
+                   if x[0]]
 
     if required_values:
 
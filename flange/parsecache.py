@@ -0,0 +1,184 @@
+import os, time, hashlib, pickle, threading
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join('~', '.cache')), 'flange', 'parse')
+DEFAULT_CACHE_MAX_SIZE = 64 * 1024 * 1024
+
+# Part of every key. Bump when the parsed representation changes so old entries are not used
+CACHE_VERSION = 3
+
+ENTRY_SUFFIX = '.pickle'
+
+# A file modified this close to when it was read may change again without its mtime changing, at
+# least on file systems with coarse timestamps. Contents parsed from it are not cached
+CACHE_RACY_NS = 2 * 10**9
+
+
+
+class ParseCache(object):
+    """
+    Directory of parsed file contents keyed by (realpath, size, mtime_ns) and, optionally, a hash of
+    the file contents. Entries are pickled with the highest protocol.
+
+    Safe for many processes at once: entries are written to a temporary file and renamed into place,
+    a missing or unreadable entry is a miss, and every entry stores its full key which is compared on
+    read. Total size is capped by evicting the least recently used entries. A hit touches the entry
+    mtime so the entry mtime is its last use.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_DIR, max_size=DEFAULT_CACHE_MAX_SIZE, hash_contents=False):
+        """
+        :param path: cache directory. Created if needed
+        :param max_size: max total bytes of all entries
+        :param hash_contents: if True the key includes a hash of the file contents. This catches
+        changes that keep the same size and mtime at the cost of reading each file
+        """
+        self.path = os.path.expanduser(path)
+        self.max_size = max_size
+        self.hash_contents = hash_contents
+        self.hits = 0
+        self.misses = 0
+        self._written = None
+        self._lock = threading.Lock()
+
+
+    def __repr__(self):
+        return '<ParseCache {} hits={} misses={}>'.format(self.path, self.hits, self.misses)
+
+    def __getstate__(self):
+        # sent to worker processes. The lock can't be pickled
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+    def key(self, uri, st=None):
+        st = st or os.stat(uri)
+        key = (CACHE_VERSION, os.path.realpath(uri), st.st_size, st.st_mtime_ns)
+        if self.hash_contents:
+            h = hashlib.blake2b(digest_size=20)
+            with open(uri, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    h.update(chunk)
+            key += (h.hexdigest(),)
+        return key
+
+
+    def stable(self, uri, st, started):
+        """
+        Whether contents parsed from uri can be put under the key made from st. The file must be
+        unchanged since st was taken and must not have been modified within CACHE_RACY_NS of started
+
+        :param st: os.stat result the key was made from
+        :param started: time.time() before st was taken
+        """
+        try:
+            now = os.stat(uri)
+        except OSError:
+            return False
+        return ((now.st_size, now.st_mtime_ns) == (st.st_size, st.st_mtime_ns)
+                and st.st_mtime_ns + CACHE_RACY_NS <= int(started * 1e9))
+
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + ENTRY_SUFFIX)
+
+
+    def get(self, key):
+        """
+        :return: (contents, parser) or None
+        """
+        path = self._entry_path(key)
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+            if entry[0] != key:
+                raise KeyError(key)
+        except Exception:
+            self.misses += 1
+            return None
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return entry[1], entry[2]
+
+
+    def put(self, key, contents, parser):
+        path = self._entry_path(key)
+        tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(self.path, mode=0o700, exist_ok=True)
+            with open(tmp, 'wb') as f:
+                pickle.dump((key, contents, parser), f, pickle.HIGHEST_PROTOCOL)
+                size = f.tell()
+            os.replace(tmp, path)
+        except Exception:
+            # unpicklable contents or an unwritable cache. Caching is best effort
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return False
+
+        with self._lock:
+            # check the total size on the first write and then after every 10% of max_size written
+            check = self._written is None or self._written + size > self.max_size // 10
+            self._written = 0 if check else self._written + size
+        if check:
+            self.evict()
+        return True
+
+
+    def evict(self):
+        """
+        Remove least recently used entries until the total size is below 80% of max_size
+        """
+        entries = []
+        total = 0
+        try:
+            with os.scandir(self.path) as it:
+                for e in it:
+                    if e.name.endswith(ENTRY_SUFFIX):
+                        try:
+                            st = e.stat()
+                        except OSError:
+                            continue
+                        entries.append((st.st_mtime_ns, st.st_size, e.path))
+                        total += st.st_size
+        except OSError:
+            return
+
+        if total <= self.max_size:
+            return
+
+        entries.sort()
+        target = self.max_size * 8 // 10
+        for mtime, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # another process got there first
+                pass
+            total -= size
+
+
+    def clear(self):
+        try:
+            with os.scandir(self.path) as it:
+                for e in it:
+                    if e.name.endswith(ENTRY_SUFFIX):
+                        try:
+                            os.remove(e.path)
+                        except OSError:
+                            pass
+        except OSError:
+            pass
@@ -1,5 +1,30 @@
 import os
+import re
+import json
+import time
+import mmap
+import json.decoder
+import json.scanner
+import codecs
+import copy
+import pickle
 import anyconfig
+import urllib.parse
+from . import httppool, discovery
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+try:
+    import yaml
+    from yaml import CSafeLoader
+except ImportError:
+    # no libyaml. yaml goes through anyconfig
+    CSafeLoader = None
+
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
 
 
 
@@ -15,6 +40,108 @@ PARSABLES = {
 
 
 
+def _load_yaml(f):
+    contents = yaml.load(f, Loader=CSafeLoader)
+    # anyconfig gives an empty mapping for an empty document
+    return {} if contents is None else contents
+
+
+# Parsers for the common formats that skip anyconfig and build plain (ordered) dicts with C accelerated
+# loaders. Each takes a file object opened in binary mode. Other formats go through anyconfig.
+FAST_PARSERS = {'json': json.load}
+if CSafeLoader:
+    FAST_PARSERS['yaml'] = _load_yaml
+if tomllib:
+    FAST_PARSERS['toml'] = tomllib.load
+
+# formats that SourceFileStream can parse as a stream of events
+STREAMABLE_PARSABLES = ['yaml', 'json']
+
+# Fast parsers that take the whole text. Files of at least mmap_size bytes in these formats are mapped
+# and decoded straight from the mapping rather than read into a bytes object first. yaml is not here,
+# libyaml already reads the file in chunks. name -> (parser, encoding)
+MMAP_PARSERS = {'json': (json.loads, 'utf-8-sig')}
+if tomllib:
+    MMAP_PARSERS['toml'] = (tomllib.loads, 'utf-8')
+
+# extension -> parser name
+PARSABLE_EXTENSIONS = dict((ext, p) for p, exts in PARSABLES.items() for ext in exts)
+
+
+# parsers for formats that are expected to be binary. These skip the binary content check
+BINARY_PARSABLES = ['pickle']
+
+# Files larger than this are not parsed. Set max_size=None on the source to disable
+DEFAULT_MAX_FILE_SIZE = 16 * 1024 * 1024
+
+# Files at least this large are memory mapped by parsers in MMAP_PARSERS. None to always read
+DEFAULT_MMAP_SIZE = 1024 * 1024
+
+# number of leading bytes inspected for binary content
+SNIFF_SIZE = 4096
+
+
+
+SNIFF_INI_SECTION = re.compile(r'^\[\s*[A-Za-z_.][^\[\]{},]*\]\s*(?:[#;].*)?$')
+SNIFF_SHELLVAR = re.compile(r'^(?:export\s+)?[A-Za-z_][A-Za-z0-9_]*=')
+SNIFF_ASSIGNMENT = re.compile(r'^[^\s:=#;][^:=]*=')
+SNIFF_YAML_KEY = re.compile(r'^[^\s:=#;][^:=]*:(?:\s|$)')
+
+
+def sniff_parsers(head):
+    """
+    Rank the likely parsers for a file from its leading bytes
+
+    :param head: leading bytes of the file
+    :return: list of parser names from PARSABLES, most likely first
+    """
+    text = head.decode('utf-8', 'ignore').lstrip('\ufeff')
+    stripped = text.lstrip()
+
+    if not stripped:
+        return ['properties']
+    if stripped.startswith('<'):
+        return ['xml']
+    if stripped.startswith('{'):
+        return ['json', 'yaml']
+    if stripped.startswith('---') or stripped.startswith('%YAML'):
+        return ['yaml']
+
+    # decide on the first line that is not blank or a comment
+    for line in stripped.splitlines():
+        line = line.strip()
+        if not line or line[0] in '#;':
+            continue
+        if SNIFF_INI_SECTION.match(line):
+            return ['ini', 'toml']
+        if line.startswith('['):
+            return ['json', 'yaml']
+        if line.startswith('- '):
+            return ['yaml']
+        if SNIFF_SHELLVAR.match(line):
+            return ['shellvars', 'properties']
+        if SNIFF_ASSIGNMENT.match(line):
+            return ['toml', 'properties']
+        if SNIFF_YAML_KEY.match(line):
+            return ['yaml', 'properties']
+        break
+
+    return ['yaml', 'properties']
+
+
+
+class SourceRejected(ValueError):
+    """
+    Raised, and recorded as the Source error, when a file is not parsed because of its size or content
+    """
+
+    def __init__(self, uri, reason):
+        super(SourceRejected, self).__init__('{} rejected: {}'.format(uri, reason))
+        self.uri = uri
+        self.reason = reason
+
+
+
 class Source(object):
 
     def __init__(self, uri, root_path=None, contents={}, parser=None, error=None):
@@ -23,6 +150,7 @@ class Source(object):
         self.error = error
         self.parser = parser
         self.contents = contents
+        self.loaded = True
 
 
     def __repr__(self):
@@ -36,6 +164,13 @@ class Source(object):
         pass
 
 
+    def changed(self):
+        """
+        :return: True if the source needs to be loaded again
+        """
+        return False
+
+
     @staticmethod
     def from_file(full_file_path, root_path):
         s = SourceFile(full_file_path, root_path)
@@ -44,18 +179,182 @@ class Source(object):
 
 
 
+class SourceEnv(Source):
+    """
+    Variables of the OS environment. Only the variables matching the given patterns are taken, so the
+    rest are never unflattened, indexed or researched.
+    """
+
+    def __init__(self, uri='os_env', root_path=None, patterns=None, strip_prefix=False, environ=None):
+        """
+        :param patterns: list of variable name prefixes or glob patterns. A pattern without wildcards is a
+        prefix. None takes every variable
+        :param strip_prefix: if True the prefix of the pattern a variable matched, up to its first wildcard,
+        is removed from the key. A variable left with an empty key is skipped
+        :param environ: mapping to read instead of os.environ
+        """
+        super(SourceEnv, self).__init__(uri, root_path, {}, None, None)
+        self.environ = environ
+        self.strip_prefix = strip_prefix
+        self.patterns = list(patterns) if patterns is not None else None
+        self.matcher = None
+        self.prefixes = []
+        if self.patterns is not None:
+            globs = []
+            for p in self.patterns:
+                magic = discovery.PatternSet.MAGIC.search(p)
+                globs.append(p if magic else p + '*')
+                self.prefixes.append(p[:magic.start()] if magic else p)
+            self.matcher = discovery.PatternSet(globs)
+            # strip the longest prefix a name has
+            self.prefixes.sort(key=len, reverse=True)
+        self.load()
+
+
+    def __str__(self):
+        return "<SourceEnv uri={} root_path={} patterns={} #vars={}>".format(self.uri, self.root_path, self.patterns, len(self.contents))
+
+
+    def load(self):
+
+        environ = os.environ if self.environ is None else self.environ
+        if self.matcher is None:
+            self.contents = dict(environ)
+            return
+
+        contents = {}
+        for name, value in environ.items():
+            if not self.matcher.match(name):
+                continue
+            key = name
+            if self.strip_prefix:
+                key = name[len(next((p for p in self.prefixes if name.startswith(p)), '')):]
+                if not key:
+                    continue
+            contents[key] = value
+        self.contents = contents
+
+
+
 class SourceFile(Source):
 
+    # attributes set by load(). These are sent back to the parent when loading in a worker process
+    LOADED_ATTRS = ('contents', 'parser', 'error', 'size', 'mtime_ns', 'cached', 'detect_time', 'loaded')
+
+    def __init__(self, uri, root_path=None, contents={}, parser=None, error=None, max_size=DEFAULT_MAX_FILE_SIZE,
+                 cache=None, mmap_size=DEFAULT_MMAP_SIZE):
+        """
+        :param max_size: files larger than this many bytes are rejected without parsing. None for no limit
+        :param cache: optional parsecache.ParseCache used to skip parsing unchanged files
+        :param mmap_size: json and toml files of at least this many bytes are parsed from a memory map of
+        the file. None to always read the file
+        """
+        super(SourceFile, self).__init__(uri, root_path, contents, parser, error)
+        self.max_size = max_size
+        self.mmap_size = mmap_size
+        self.cache = cache
+        self.size = None
+        self.mtime_ns = None
+        self.cached = False
+        self.detect_time = None
+        self.loaded = False
+
+
+    def changed(self):
+        """
+        Cheap stat based check.
+
+        :return: True if the file has never been loaded or its size or mtime differ from when it was loaded
+        """
+        try:
+            st = os.stat(self.uri)
+        except OSError:
+            # already known to be missing if the last load failed the same way
+            return not isinstance(self.error, OSError)
+        return (st.st_size, st.st_mtime_ns) != (self.size, self.mtime_ns)
+
+
+    def _check(self):
+        """
+        Cheap checks done before any parser runs. Raises SourceRejected for files that are too large or
+        look binary (NUL bytes or invalid UTF-8 in the leading bytes)
+
+        :return: (os.stat result, leading bytes of the file or None if not read)
+        """
+        st = os.stat(self.uri)
+        self.size = st.st_size
+        self.mtime_ns = st.st_mtime_ns
+        if self.max_size and self.size > self.max_size:
+            raise SourceRejected(self.uri, 'size {} exceeds max_size {}'.format(self.size, self.max_size))
+
+        ext = os.path.splitext(self.uri)[1][1:]
+        if [p for p in BINARY_PARSABLES if ext in PARSABLES[p]]:
+            return st, None
+
+        with open(self.uri, 'rb') as f:
+            head = f.read(SNIFF_SIZE)
+        if b'\0' in head:
+            raise SourceRejected(self.uri, 'binary content')
+        try:
+            # not final. The sniffed bytes may end in the middle of a multibyte character
+            codecs.getincrementaldecoder('utf-8')().decode(head, final=False)
+        except UnicodeDecodeError:
+            raise SourceRejected(self.uri, 'content is not valid utf-8')
+        return st, head
+
 
     def _parse(self, parser=None):
 
-        contents = anyconfig.load(self.uri, ac_parser=parser, ac_ordered=True)
-        parser = parser if parser else os.path.splitext(self.uri)[1].strip('.')
+        ext = os.path.splitext(self.uri)[1].strip('.')
+        name = parser if parser else PARSABLE_EXTENSIONS.get(ext)
+        fast = FAST_PARSERS.get(name)
+        if fast:
+            with open(self.uri, 'rb') as f:
+                if name in MMAP_PARSERS and self.mmap_size is not None and self.size and self.size >= self.mmap_size:
+                    contents = _parse_mapped(f, *MMAP_PARSERS[name])
+                else:
+                    contents = fast(f)
+        else:
+            contents = anyconfig.load(self.uri, ac_parser=parser, ac_ordered=True)
+        parser = parser if parser else ext
         return (contents, parser)
 
 
     def load(self):
 
+        self.loaded = True
+        self.error = None
+        self.cached = False
+        self.detect_time = None
+        started = time.time()
+        try:
+            st, head = self._check()
+        except (OSError, SourceRejected) as e:
+            self.contents = {}
+            self.parser = None
+            self.error = e
+            return
+
+        key = None
+        if self.cache:
+            try:
+                key = self.cache.key(self.uri, st)
+                hit = self.cache.get(key)
+            except OSError:
+                hit = None
+            if hit:
+                self.contents, self.parser = hit
+                self.cached = True
+                return
+
+        self._load_parsed(head)
+
+        if key and self.error is None and self.cache.stable(self.uri, st, started):
+            self.cache.put(key, self.contents, self.parser)
+
+
+    def _load_parsed(self, head=None):
+
         try:
             self.contents, self.parser = self._parse()
 
@@ -67,13 +366,540 @@ class SourceFile(Source):
                 self.error = e
                 # print type(e) # 'exception parsing {}\t{}'.format(ext, e)
             else:
-                for p in PARSABLES.keys():
+                # Unknown extension. Choose the parser(s) to try from the content rather than trying
+                # every parser
+                started = time.perf_counter()
+                if head is None:
+                    with open(self.uri, 'rb') as f:
+                        head = f.read(SNIFF_SIZE)
+                candidates = sniff_parsers(head)
+                self.detect_time = time.perf_counter() - started
+
+                for p in candidates:
                     try:
-                        self.contents, self.parser = self._parse(p)
+                        contents, parser = self._parse(p)
+                    except Exception as pe:
+                        self.error = pe
+                        continue
+                    # some parsers, yaml in particular, accept almost any text as a scalar
+                    if isinstance(contents, (Mapping, list)):
+                        self.contents, self.parser = contents, parser
                         self.error = None
                         break
-                    except Exception as e:
-                        # print type(e) #'exception parsing as ', p, ' ', e
-                        pass
+                    self.error = ValueError('{} parsed as {} but is not a mapping'.format(self.uri, p))
+
+
+
+
+
+def _parse_mapped(f, loads, encoding):
+    """
+    Decode the text of a file straight from a read only memory map and parse it. The mapping is closed
+    before parsing so only the decoded text is held while the contents are built.
+    """
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        text = str(mapped, encoding)
+    return loads(text)
+
+
+
+# SourceFileStream events
+START = 'start'
+SCALAR = 'scalar'
+END = 'end'
+
+_NO_KEY = object()
+
+
+def walk_events(value, key=None):
+    """
+    Events of an already parsed value, in the form of SourceFileStream.events. Mappings are walked as
+    dicts and lists as lists, anything else is a scalar
+    """
+    stack = [iter([(key, value)])]
+    while stack:
+        for k, v in stack[-1]:
+            if isinstance(v, Mapping):
+                yield START, k, {}
+                stack.append(iter(v.items()))
+            elif isinstance(v, list):
+                yield START, k, []
+                stack.append(enumerate(v))
+            else:
+                yield SCALAR, k, v
+                continue
+            break
+        else:
+            stack.pop()
+            if stack:
+                yield END, None, None
+
+
+def _yaml_events(uri):
+    """
+    Events of a yaml file from the libyaml event parser. The file is read in chunks and only scalars
+    are constructed.
+    """
+    # Only used to resolve and construct scalars. CSafeLoader is a C parser with python constructors
+    scalars = yaml.SafeLoader('')
+    undefined = scalars.yaml_constructors[None]
+
+    # anchor -> scalar value, or the events of an anchored collection so aliases of it can be replayed
+    anchors = {}
+    # [anchor, events, depth] of each anchored collection being read
+    recording = []
+    # one [is mapping, pending key or next list index] per open collection
+    stack = []
+    documents = 0
+
+    with open(uri, 'rb') as f:
+        for e in yaml.parse(f, Loader=CSafeLoader):
+
+            if isinstance(e, yaml.DocumentStartEvent):
+                documents += 1
+                if documents > 1:
+                    raise ValueError('{} has more than one document'.format(uri))
+                continue
+
+            if isinstance(e, yaml.CollectionEndEvent):
+                stack.pop()
+                events = [(END, None, None)]
+
+            elif not isinstance(e, yaml.NodeEvent):
+                continue
+
+            else:
+                if isinstance(e, yaml.ScalarEvent):
+                    tag = e.tag
+                    if tag is None or tag == '!':
+                        tag = scalars.resolve(yaml.ScalarNode, e.value, e.implicit)
+                    if tag == 'tag:yaml.org,2002:merge':
+                        raise ValueError('{}: merge keys are not supported when streaming'.format(uri))
+                    node = yaml.ScalarNode(tag, e.value, e.start_mark, e.end_mark, e.style)
+                    value = scalars.yaml_constructors.get(tag, undefined)(scalars, node)
+                elif isinstance(e, yaml.AliasEvent):
+                    value = anchors[e.anchor]
+                elif isinstance(e, yaml.MappingStartEvent):
+                    value = {}
+                else:
+                    value = []
+
+                if stack and stack[-1][0] and stack[-1][1] is _NO_KEY:
+                    if not isinstance(e, yaml.ScalarEvent):
+                        raise ValueError('{}: only scalar mapping keys are supported when streaming'.format(uri))
+                    stack[-1][1] = value
+                    continue
+
+                if not stack:
+                    key = None
+                elif stack[-1][0]:
+                    key = stack[-1][1]
+                    stack[-1][1] = _NO_KEY
+                else:
+                    key = stack[-1][1]
+                    stack[-1][1] += 1
+
+                if isinstance(e, yaml.CollectionStartEvent):
+                    stack.append([isinstance(e, yaml.MappingStartEvent), _NO_KEY if isinstance(value, dict) else 0])
+                    events = [(START, key, value)]
+                    if e.anchor:
+                        recording.append([e.anchor, [], 0])
+                elif isinstance(e, yaml.AliasEvent) and isinstance(value, list):
+                    # replay the anchored collection with new containers
+                    events = [(ev, key if i == 0 else k, type(v)() if ev == START else v)
+                              for i, (ev, k, v) in enumerate(value)]
+                else:
+                    if e.anchor:
+                        anchors[e.anchor] = (value,)
+                    events = [(SCALAR, key, value[0] if isinstance(e, yaml.AliasEvent) else value)]
+
+            for event in events:
+                for r in recording:
+                    r[1].append(event)
+                    r[2] += {START: 1, END: -1}.get(event[0], 0)
+                while recording and recording[-1][2] == 0:
+                    anchor, recorded, depth = recording.pop()
+                    anchors[anchor] = recorded
+                yield event
+
+
+
+# characters of a json file read at a time when streaming
+JSON_CHUNK_SIZE = 64 * 1024
+
+_JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_JSON_NUMBER_CHARS = re.compile(r'[-+0-9.eE]*')
+_JSON_LITERALS = [('true', True), ('false', False), ('null', None),
+                  ('NaN', float('nan')), ('Infinity', float('inf')), ('-Infinity', float('-inf'))]
+
+
+def _json_tokens(uri, chunk_size=JSON_CHUNK_SIZE):
+    """
+    Tokens of a json file read in chunks. Strings are decoded with the scanner of the json module so
+    escapes, including surrogate pairs, come out as json.load gives them.
+
+    :return: iterator of (token, value). token is one of '{}[],:' with value None, or 'v' for a string,
+    number or literal value
+    """
+    with open(uri, encoding='utf-8-sig') as f:
+        buf = ''
+        pos = 0
+        eof = False
+        while True:
+            pos = _JSON_WHITESPACE.match(buf, pos).end()
+
+            # a token cut off by the end of the buffer is retried once more has been read
+            partial = pos == len(buf)
+            if not partial:
+                c = buf[pos]
+                if c in '{}[],:':
+                    yield c, None
+                    pos += 1
+                    continue
+
+                if c == '"':
+                    try:
+                        value, end = json.decoder.scanstring(buf, pos + 1)
+                    except ValueError:
+                        if eof:
+                            raise
+                        partial = True
+                    else:
+                        yield 'v', value
+                        pos = end
+                        continue
+
+                else:
+                    m = json.scanner.NUMBER_RE.match(buf, pos)
+                    if m and (eof or _JSON_NUMBER_CHARS.match(buf, pos).end() < len(buf)):
+                        integer, frac, exp = m.groups()
+                        yield 'v', float(integer + (frac or '') + (exp or '')) if frac or exp else int(integer)
+                        pos = m.end()
+                        continue
+                    literal = next((l for l in _JSON_LITERALS if buf.startswith(l[0], pos)), None)
+                    if literal and (eof or pos + len(literal[0]) < len(buf)):
+                        yield 'v', literal[1]
+                        pos += len(literal[0])
+                        continue
+                    partial = bool(m or literal) or len(buf) - pos < len('-Infinity')
+
+            if partial and not eof:
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+            if pos == len(buf):
+                return
+            raise ValueError('{}: invalid json near {!r}'.format(uri, buf[pos:pos + 20]))
+
+
+def _json_events(uri):
+    """
+    Events of a json file, see SourceFileStream.events
+    """
+    # one [is mapping, pending key or next list index] per open collection
+    stack = []
+    # what the next token may be
+    expect = 'value'
+
+    for token, value in _json_tokens(uri):
+
+        if expect == ':':
+            if token != ':':
+                raise ValueError('{}: expected \':\' after a key'.format(uri))
+            expect = 'value'
+            continue
+
+        end = '}' if stack and stack[-1][0] else ']'
+        if expect == 'key' or expect == 'key or end':
+            if token == '}' and expect == 'key or end':
+                expect = 'end'
+            elif token == 'v' and isinstance(value, str):
+                stack[-1][1] = value
+                expect = ':'
+                continue
+            else:
+                raise ValueError('{}: expected a key'.format(uri))
+
+        elif expect == ', or end':
+            if token == ',':
+                expect = 'key' if stack[-1][0] else 'value'
+                continue
+            if token != end:
+                raise ValueError('{}: expected \',\' or \'{}\''.format(uri, end))
+            expect = 'end'
+
+        elif expect == 'value or end' and token == ']':
+            expect = 'end'
+
+        elif expect == 'done':
+            raise ValueError('{} has more than one top level value'.format(uri))
+
+        if expect == 'end':
+            stack.pop()
+            yield END, None, None
+            expect = ', or end' if stack else 'done'
+            continue
+
+        if not stack:
+            key = None
+        elif stack[-1][0]:
+            key = stack[-1][1]
+        else:
+            key = stack[-1][1]
+            stack[-1][1] += 1
+
+        if token == '{':
+            yield START, key, {}
+            stack.append([True, None])
+            expect = 'key or end'
+        elif token == '[':
+            yield START, key, []
+            stack.append([False, 0])
+            expect = 'value or end'
+        elif token == 'v':
+            yield SCALAR, key, value
+            expect = ', or end' if stack else 'done'
+        else:
+            raise ValueError('{}: unexpected \'{}\''.format(uri, token))
+
+    if expect != 'done':
+        raise ValueError('{}: unexpected end of file'.format(uri))
+
+
+
+class SourceFileStream(SourceFile):
+    """
+    A large yaml or json file that is parsed as a stream of events while sources are merged rather than
+    loaded into memory. load() only checks the file. contents stays empty and the file is parsed again
+    every time the sources are merged.
+    """
+
+    def __init__(self, uri, root_path=None, max_size=None):
+        """
+        :param max_size: files larger than this many bytes are rejected. None for no limit
+        """
+        super(SourceFileStream, self).__init__(uri, root_path, max_size=max_size)
+
+
+    def __str__(self):
+        return "<SourceFileStream uri={} root_path={} parser={} error={}>".format(self.uri, self.root_path, self.parser, self.error)
+
+
+    def load(self):
+
+        self.loaded = True
+        self.error = None
+        self.contents = {}
+        self.parser = None
+        try:
+            self._check()
+            parser = PARSABLE_EXTENSIONS.get(os.path.splitext(self.uri)[1][1:])
+            if parser not in STREAMABLE_PARSABLES:
+                raise SourceRejected(self.uri, 'only {} can be streamed'.format(' and '.join(STREAMABLE_PARSABLES)))
+            self.parser = parser
+        except (OSError, SourceRejected) as e:
+            self.error = e
+
+
+    def events(self):
+        """
+        Parse the file incrementally
+
+        :return: iterator of (event, key, value). event is START, with a new empty dict or list as value,
+        for a collection whose items follow until the matching END. SCALAR is any other value. key is
+        the mapping key or list index of the value in its parent, None for the top level value
+        """
+        if self.parser == 'json':
+            return _json_events(self.uri)
+        if CSafeLoader is None:
+            # no event parser available. walk a fully parsed copy
+            return walk_events(self._parse(self.parser)[0])
+        return _yaml_events(self.uri)
+
+
+
+
+# media type of a Content-Type header -> parser name
+HTTP_CONTENT_TYPES = {
+    'application/json': 'json',
+    'application/yaml': 'yaml',
+    'application/x-yaml': 'yaml',
+    'text/yaml': 'yaml',
+    'text/x-yaml': 'yaml',
+    'application/toml': 'toml',
+    'application/xml': 'xml',
+    'text/xml': 'xml'}
+
+
+def _parse_text(body, parser):
+    """
+    Parse bytes with the named parser. The fast parsers are used where there is one
+
+    :return: contents
+    """
+    if parser == 'json':
+        return json.loads(body.decode('utf-8-sig'))
+    if parser == 'yaml' and CSafeLoader:
+        return _load_yaml(body)
+    if parser == 'toml' and tomllib:
+        return tomllib.loads(body.decode('utf-8'))
+    return anyconfig.loads(body.decode('utf-8-sig'), ac_parser=parser, ac_ordered=True)
+
+
+
+class SourceHttp(Source):
+    """
+    Config fetched with a GET from an http(s) url. Connections are kept alive in a shared pool, and a
+    refresh sends If-None-Match and If-Modified-Since from the last response. On 304 Not Modified the
+    contents parsed before are kept.
+
+    The parser is, in order, the one given, the one for the Content-Type of the response, the one for
+    the extension of the url path or the one sniffed from the body.
+    """
+
+    def __init__(self, uri, root_path=None, parser=None, timeout=httppool.DEFAULT_HTTP_TIMEOUT, headers=None,
+                 pool=None):
+        """
+        :param parser: parser name from PARSABLES. None to choose from the response
+        :param timeout: seconds to wait to connect and for each read from this source
+        :param headers: optional dict of extra request headers
+        :param pool: httppool.ConnectionPool. None for the shared httppool.POOL
+        """
+        super(SourceHttp, self).__init__(uri, root_path, {}, None, None)
+        self.forced_parser = parser
+        self.timeout = timeout
+        self.headers = headers or {}
+        self.pool = pool or httppool.POOL
+        self.etag = None
+        self.last_modified = None
+        self.status = None
+        self.loaded = False
+
+
+    def __str__(self):
+        return "<SourceHttp uri={} root_path={} parser={} status={} error={}>".format(
+            self.uri, self.root_path, self.parser, self.status, self.error)
+
+
+    def changed(self):
+        # only the server knows. The conditional GET of a load is cheap when nothing changed
+        return True
+
+
+    def load(self):
+
+        self.loaded = True
+        headers = dict(self.headers)
+        if self.error is None and self.status is not None:
+            if self.etag:
+                headers['If-None-Match'] = self.etag
+            if self.last_modified:
+                headers['If-Modified-Since'] = self.last_modified
+
+        try:
+            self.status, response_headers, body = self.pool.request(self.uri, headers, self.timeout)
+        except Exception as e:
+            self.status = None
+            self.contents = {}
+            self.error = e
+            return
+
+        if self.status == 304:
+            return
+
+        self.error = None
+        self.etag = response_headers.get('ETag')
+        self.last_modified = response_headers.get('Last-Modified')
+        if self.status != 200:
+            self.contents = {}
+            self.error = ValueError('{} returned http status {}'.format(self.uri, self.status))
+            return
+
+        try:
+            self.parser = self._choose_parser(response_headers, body)
+            self.contents = _parse_text(body, self.parser)
+            if not isinstance(self.contents, (Mapping, list)):
+                raise ValueError('{} parsed as {} but is not a mapping'.format(self.uri, self.parser))
+        except Exception as e:
+            self.contents = {}
+            self.error = e
+            # parse again next time rather than trust the validators of a response that didn't parse
+            self.etag = self.last_modified = None
+
+
+    def _choose_parser(self, headers, body):
+        if self.forced_parser:
+            return self.forced_parser
+        media_type = (headers.get('Content-Type') or '').split(';')[0].strip().lower()
+        if media_type in HTTP_CONTENT_TYPES:
+            return HTTP_CONTENT_TYPES[media_type]
+        ext = os.path.splitext(urllib.parse.urlsplit(self.uri).path)[1][1:]
+        if ext in PARSABLE_EXTENSIONS:
+            return PARSABLE_EXTENSIONS[ext]
+        return sniff_parsers(body[:SNIFF_SIZE])[0]
+
+
+
+
+def _load_in_process(src):
+    """
+    Load a source in a worker process and return the loaded attributes pickled with the highest protocol
+    """
+    src.load()
+    state = tuple(getattr(src, a) for a in src.LOADED_ATTRS)
+    try:
+        return pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        # the parse exception itself may not pickle. keep the message
+        if src.error is None:
+            raise
+        src.error = ValueError(str(src.error))
+        return pickle.dumps(tuple(getattr(src, a) for a in src.LOADED_ATTRS), pickle.HIGHEST_PROTOCOL)
+
+
+
+def _for_process(src):
+    """
+    Copy of a source to send to a worker process. The contents of an earlier load are not needed by
+    load() and are left behind rather than pickled
+    """
+    src = copy.copy(src)
+    src.contents = {}
+    return src
+
+
+
+def load_all(sources, workers=None, mode='thread'):
+    """
+    Load a list of sources. File sources can be parsed concurrently on a pool of threads or processes.
+    Each source is loaded in place so the order of the list, and therefore merge precedence, is kept.
+
+    :param sources: list of Source
+    :param workers: number of pool workers. None or < 2 loads one source at a time
+    :param mode: 'thread' or 'process'. In process mode the parsed contents are returned to the parent pickled
+    """
+    if mode not in ('thread', 'process'):
+        raise ValueError("mode must be 'thread' or 'process', not {}".format(mode))
+
+    pooled = [s for s in sources if isinstance(s, SourceFile)]
+    if not workers or workers < 2 or len(pooled) < 2:
+        pooled = []
+
+    in_pool = set(pooled)
+    for s in sources:
+        if s not in in_pool:
+            s.load()
 
+    if not pooled:
+        return
 
+    if mode == 'process':
+        with ProcessPoolExecutor(max_workers=min(workers, len(pooled))) as pool:
+            for s, state in zip(pooled, pool.map(_load_in_process, [_for_process(s) for s in pooled], chunksize=max(1, len(pooled) // (4 * workers)))):
+                for a, v in zip(s.LOADED_ATTRS, pickle.loads(state)):
+                    setattr(s, a, v)
+    else:
+        with ThreadPoolExecutor(max_workers=min(workers, len(pooled))) as pool:
+            list(pool.map(lambda s: s.load(), pooled))
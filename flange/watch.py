@@ -0,0 +1,224 @@
+import os, errno, select, struct, threading, time
+import ctypes, ctypes.util
+
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+EVENT_HEADER = struct.Struct('iIII')
+
+DEFAULT_LATENCY = 0.05
+MAX_LATENCY = 1.0
+STOP_TIMEOUT = 5.0
+
+
+_libc = None
+def _get_libc():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available on this platform')
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        _libc = libc
+    return _libc
+
+
+def available():
+    try:
+        _get_libc()
+        return True
+    except OSError:
+        return False
+
+
+
+class Inotify(object):
+    """
+    Minimal ctypes binding of the Linux inotify API
+    """
+
+    def __init__(self):
+        self.libc = _get_libc()
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        return wd
+
+
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+
+    def read(self, timeout=None):
+        """
+        :return: list of (wd, mask, cookie, name) events. Empty if none arrived within timeout seconds
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        pos = 0
+        while pos + EVENT_HEADER.size <= len(buf):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(buf, pos)
+            pos += EVENT_HEADER.size
+            name = os.fsdecode(buf[pos:pos + length].rstrip(b'\0'))
+            pos += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+
+class Watcher(object):
+    """
+    Watch a set of directories on a background thread. Events are coalesced until no new event has
+    arrived for 'latency' seconds, then the handler is called with the set of changed paths. The
+    handler is expected to look at the current state of each path rather than at the event kinds,
+    so that reordered or repeated events give the same result.
+    """
+
+    def __init__(self, handler, latency=DEFAULT_LATENCY):
+        """
+        :param handler: func(paths, overflow) called on the watcher thread. paths is a set of changed
+        file and directory paths. overflow is True if the kernel dropped events, in which case paths
+        is incomplete and everything should be rescanned
+        :param latency: seconds without events to wait before calling the handler
+        """
+        self.handler = handler
+        self.latency = latency
+        self.inotify = Inotify()
+        self.wds = {}
+        self.dirs = {}
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.exception = None
+
+
+    def __repr__(self):
+        return '<Watcher #dirs={} running={}>'.format(len(self.dirs), self.running())
+
+
+    def add(self, path):
+        with self.lock:
+            if path in self.dirs:
+                return
+            try:
+                wd = self.inotify.add_watch(path)
+            except OSError:
+                # the directory has gone away or can't be read. Nothing to watch
+                return
+            self.wds[wd] = path
+            self.dirs[path] = wd
+
+
+    def remove(self, path):
+        with self.lock:
+            wd = self.dirs.pop(path, None)
+            if wd is not None:
+                self.wds.pop(wd, None)
+                self.inotify.rm_watch(wd)
+
+
+    def sync(self, paths):
+        paths = set(paths)
+        for path in [p for p in self.dirs if p not in paths]:
+            self.remove(path)
+        for path in paths:
+            self.add(path)
+
+
+    def start(self):
+        if not self.running():
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self.run, name='flange-watch', daemon=True)
+            self.thread.start()
+
+
+    def stop(self, timeout=None):
+        self.stopping.set()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join(timeout)
+        self.inotify.close()
+
+
+    def running(self):
+        return bool(self.thread and self.thread.is_alive())
+
+
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                events = self.inotify.read(0.2)
+                if not events:
+                    continue
+
+                # coalesce a burst of events
+                paths = set()
+                overflow = False
+                started = time.time()
+                while events:
+                    overflow |= self.__collect(events, paths)
+                    if time.time() - started > MAX_LATENCY:
+                        break
+                    events = self.inotify.read(self.latency)
+
+                if paths or overflow:
+                    self.handler(paths, overflow)
+
+            except Exception as e:
+                if self.stopping.is_set():
+                    break
+                # keep watching. the last exception is kept for inspection
+                self.exception = e
+
+
+    def __collect(self, events, paths):
+        overflow = False
+        with self.lock:
+            for wd, mask, cookie, name in events:
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                dir = self.wds.get(wd)
+                if dir is None:
+                    continue
+                if mask & IN_IGNORED:
+                    # the watch was removed, either explicitly or because the directory was deleted
+                    self.wds.pop(wd, None)
+                    if self.dirs.get(dir) == wd:
+                        del self.dirs[dir]
+                    continue
+                paths.add(os.path.join(dir, name) if name else dir)
+        return overflow
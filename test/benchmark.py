@@ -0,0 +1,386 @@
+"""
+Benchmarks. Not run by pytest.
+
+    python -m test.benchmark            # all
+    python -m test.benchmark parse      # one by name
+"""
+import gc
+import os
+import sys
+import copy
+import json
+import time
+import shutil
+import tempfile
+import asyncio
+import subprocess
+import tracemalloc
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import anyconfig
+import dpath.util
+
+from flange import cfg, iterutils, source
+
+
+
+def timed(f, repeat=3):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        f()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def make_yaml_corpus(dir, files=200, entries=200):
+    for i in range(files):
+        with open(os.path.join(dir, 'cfg{:04d}.yml'.format(i)), 'w') as f:
+            f.write('app{}:\n'.format(i))
+            for j in range(entries):
+                f.write('  key{}:\n    name: value {}\n    port: {}\n    enabled: true\n    tags: [a, b, c]\n'.format(j, j, j))
+
+
+
+def make_json_corpus(dir, files=200, entries=200):
+    for i in range(files):
+        with open(os.path.join(dir, 'cfg{:04d}.json'.format(i)), 'w') as f:
+            json.dump({'app{}'.format(i): dict(('key{}'.format(j), {'name': 'value {}'.format(j), 'port': j,
+                                                                   'enabled': True, 'tags': ['a', 'b', 'c']})
+                                               for j in range(entries))}, f)
+
+
+
+#
+#   benchmarks
+#
+
+def bench_parse():
+    """
+    Load corpora of yaml and json files with and without the C accelerated fast parsers
+    """
+    for fmt, make in [('yml', make_yaml_corpus), ('json', make_json_corpus)]:
+        dir = tempfile.mkdtemp()
+        try:
+            make(dir)
+            load = lambda: cfg.Cfg(base_dir=dir, file_patterns=['*.' + fmt], include_os_env=False,
+                                   merge=False, research=False)
+
+            saved = source.FAST_PARSERS.copy()
+            fast = slow = None
+            for _ in range(3):
+                f = timed(load, 1)
+                source.FAST_PARSERS.clear()
+                try:
+                    s = timed(load, 1)
+                finally:
+                    source.FAST_PARSERS.update(saved)
+                fast = f if fast is None else min(fast, f)
+                slow = s if slow is None else min(slow, s)
+
+            print('parse: 200 {} files x 200 entries. anyconfig {:.3f}s, fast path {:.3f}s ({:.1f}x)'.format(
+                fmt, slow, fast, slow / fast))
+        finally:
+            shutil.rmtree(dir)
+
+
+
+def peak_rss(code):
+    """
+    Run code in a new interpreter and return its peak resident set size in MiB
+    """
+    code = 'import resource, sys\nsys.path.insert(0, {!r})\n{}\nprint(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)'.format(
+        os.path.abspath(os.path.join(os.path.dirname(__file__), '..')), code)
+    out = subprocess.run([sys.executable, '-c', code], check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return int(out.split()[-1]) / 1024.0
+
+
+def bench_stream():
+    """
+    Peak memory of loading one large json inventory file with and without streaming
+    """
+    dir = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(dir, 'inventory.json'), 'w') as f:
+            json.dump({'hosts': dict(('host{}'.format(i), {'ip': '10.0.{}.{}'.format(i // 256 % 256, i % 256),
+                                                           'roles': ['web', 'db'], 'rack': i % 40, 'up': True,
+                                                           'notes': 'host {} '.format(i) * 40})
+                                     for i in range(50000))}, f)
+        size = os.path.getsize(os.path.join(dir, 'inventory.json')) / 1024.0 / 1024.0
+
+        code = ('from flange import cfg\nc = cfg.Cfg(base_dir={!r}, file_patterns=["*.json"], include_os_env=False, '
+                'max_file_size=None, stream_file_size={}, research=False)')
+        baseline = peak_rss('from flange import cfg')
+        loaded = peak_rss(code.format(dir, None))
+        streamed = peak_rss(code.format(dir, 0))
+        print('stream: {:.0f} MiB json. peak rss above import: loaded {:.0f} MiB, streamed {:.0f} MiB'.format(
+            size, loaded - baseline, streamed - baseline))
+    finally:
+        shutil.rmtree(dir)
+
+
+
+def bench_mmap():
+    """
+    Peak memory of parsing one large json file read into memory and memory mapped
+    """
+    dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(dir, 'large.json')
+        with open(path, 'w') as f:
+            json.dump(dict(('key{}'.format(i), 'value {} '.format(i) * 200) for i in range(50000)), f)
+        size = os.path.getsize(path) / 1024.0 / 1024.0
+
+        code = 'from flange import source\ns = source.SourceFile({!r}, max_size=None, mmap_size={})\ns.load()\nassert not s.error'
+        baseline = peak_rss('from flange import source')
+        read = peak_rss(code.format(path, None))
+        mapped = peak_rss(code.format(path, 0))
+        print('mmap: {:.0f} MiB json. peak rss above import: read {:.0f} MiB, mapped {:.0f} MiB'.format(
+            size, read - baseline, mapped - baseline))
+    finally:
+        shutil.rmtree(dir)
+
+
+
+def bench_async():
+    """
+    Longest event loop stall while building a Cfg with Cfg.create. Research is off, it is slow for
+    reasons unrelated to the loop
+    """
+    dir = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(dir, 'entries.json'), 'w') as f:
+            json.dump(dict(('key{}'.format(i), {'name': 'value {}'.format(i), 'port': i}) for i in range(20000)), f)
+
+        async def main():
+            stalls = []
+
+            async def ticker():
+                last = time.perf_counter()
+                while True:
+                    await asyncio.sleep(0)
+                    now = time.perf_counter()
+                    stalls.append(now - last)
+                    last = now
+
+            t = asyncio.ensure_future(ticker())
+            await asyncio.sleep(0)
+            started = time.perf_counter()
+            await cfg.Cfg.create(base_dir=dir, file_patterns=['*.json'], include_os_env=False, root_path='ns',
+                                 research=False)
+            elapsed = time.perf_counter() - started
+            t.cancel()
+            return elapsed, max(stalls)
+
+        elapsed, stall = asyncio.get_event_loop().run_until_complete(main())
+        started = time.perf_counter()
+        cfg.Cfg(base_dir=dir, file_patterns=['*.json'], include_os_env=False, root_path='ns', research=False)
+        print('async: 20k entries. Cfg() {:.3f}s blocking, Cfg.create {:.3f}s with longest loop stall {:.1f}ms'.format(
+            time.perf_counter() - started, elapsed, stall * 1000))
+    finally:
+        shutil.rmtree(dir)
+
+
+
+def bench_merge():
+    """
+    Merge of 250 overlapping source trees: anyconfig.merge of each in turn against merge_all_steps
+    """
+    def tree(i):
+        return {'common': dict(('svc{}'.format(j), {'port': i, 'host': 'h{}'.format(j), 'opts': {'a': i, 'b{}'.format(i % 5): 1}})
+                               for j in range(50)),
+                'own{}'.format(i): {'x': {'y': i}}}
+    trees = [tree(i) for i in range(250)]
+
+    def best(merge):
+        times = []
+        for _ in range(3):
+            copies = copy.deepcopy(trees)
+            started = time.perf_counter()
+            merge(copies)
+            times.append(time.perf_counter() - started)
+        return min(times)
+
+    def each(copies):
+        merged = {}
+        for t in copies:
+            anyconfig.merge(merged, t)
+
+    print('merge: 250 sources. anyconfig.merge each {:.3f}s, merge_all_steps {:.3f}s'.format(
+        best(each), best(lambda copies: iterutils.run_steps(iterutils.merge_all_steps(copies)))))
+
+
+
+def bench_provenance():
+    """
+    Memory of a Cfg with 180k indexed paths from 20 sources, and of its provenance kept as masks against
+    the sets of sources it was kept as before
+    """
+    dir = tempfile.mkdtemp()
+    try:
+        for i in range(20):
+            with open(os.path.join(dir, 'f{:02d}.json'.format(i)), 'w') as f:
+                json.dump({'app{}'.format(i): dict(('k{}'.format(j), {'name': 'v', 'port': j, 'tags': ['a', 'b']})
+                                                   for j in range(1500)),
+                           'common': dict(('c{}'.format(j), i) for j in range(200))}, f)
+
+        tracemalloc.start()
+        c = cfg.Cfg(base_dir=dir, file_patterns=['*.json'], include_os_env=False, research=False)
+        total = tracemalloc.get_traced_memory()[0]
+        entries = list(c.path_index.values())
+        masks = dict((id(e.mask), sys.getsizeof(e.mask)) for e in entries)
+        started = tracemalloc.get_traced_memory()[0]
+        sets = [e.srcs for e in entries]
+        as_sets = tracemalloc.get_traced_memory()[0] - started
+        tracemalloc.stop()
+
+        print('provenance: {} paths. Cfg {:.1f}MB. provenance as masks {:.2f}MB, as sets {:.1f}MB'.format(
+            len(entries), total / 2**20, (sum(masks.values()) + 8 * len(entries)) / 2**20, as_sets / 2**20))
+    finally:
+        shutil.rmtree(dir)
+
+
+
+def bench_unflatten():
+    """
+    unflatten of 20k entries with no compound keys and with some in every entry
+    """
+    plain = dict(('app{}'.format(i), {'name': 'v', 'port': i, 'tags': ['a', 'b'], 'opts': {'x': 1}}) for i in range(20000))
+    compound = dict(('app{}__cfg'.format(i), {'name': 'v', 'port': i, 'tags': ['a', 'b'], 'opts__x': 1}) for i in range(20000))
+    print('unflatten: 20k entries. no compound keys {:.3f}s, compound keys {:.3f}s'.format(
+        timed(lambda: iterutils.unflatten(plain, '__')), timed(lambda: iterutils.unflatten(compound, '__'))))
+
+
+
+def bench_remerge():
+    """
+    Change one key in one of 500 files: a full refresh against an incremental one
+    """
+    dir = tempfile.mkdtemp()
+    try:
+        for i in range(500):
+            with open(os.path.join(dir, 'cfg{:03d}.json'.format(i)), 'w') as f:
+                json.dump({'app{}'.format(i): {'name': 'app {}'.format(i), 'port': i},
+                           'common': {'svc{}'.format(i % 20): {'weight': i}}}, f)
+        c = cfg.Cfg(base_dir=dir, file_patterns=['*.json'], include_os_env=False)
+
+        path = os.path.join(dir, 'cfg250.json')
+        def change(port):
+            with open(path, 'w') as f:
+                json.dump({'app250': {'name': 'app 250', 'port': port}, 'common': {'svc10': {'weight': port}}}, f)
+            t = time.time() + port
+            os.utime(path, (t, t))
+
+        change(1)
+        full = timed(lambda: c.refresh(load=True))
+        ports = iter(range(2, 100))
+        incremental = timed(lambda: (change(next(ports)), c.refresh(incremental=True)))
+        assert c.value('app250/port') == next(ports) - 1
+        print('remerge: 1 of 500 files changed. full refresh {:.3f}s, incremental {:.4f}s'.format(full, incremental))
+    finally:
+        shutil.rmtree(dir)
+
+
+
+def bench_index():
+    """
+    Build a Cfg with a 1M node index, then the time and memory of making its entries as slotted
+    PathCacheObjects against entries with a __dict__, registrations dict and sources set of their own
+    """
+    dir = tempfile.mkdtemp()
+    try:
+        for i in range(20):
+            with open(os.path.join(dir, 'f{:02d}.yml'.format(i)), 'w') as f:
+                f.write('app{}:\n'.format(i))
+                for j in range(8400):
+                    f.write('  k{}:\n    name: v\n    port: {}\n    tags: [a, b]\n'.format(j, j))
+        started = time.perf_counter()
+        c = cfg.Cfg(base_dir=dir, file_patterns=['*.yml'], include_os_env=False, research=False)
+        built = time.perf_counter() - started
+    finally:
+        shutil.rmtree(dir)
+
+    class Eager(object):
+        def __init__(self, val, path, src):
+            self.val = val
+            self.mregs = {}
+            self.srcs = {src}
+            self.path = path
+
+    items = [(path, entry.val) for path, entry in c.path_index.items()]
+    ids, src = c.source_ids, c.sources[0]
+    mask = ids.mask(src)
+
+    def make(new):
+        gc.collect()
+        elapsed = timed(lambda: [new(val, path) for path, val in items], 1)
+        tracemalloc.start()
+        entries = [new(val, path) for path, val in items]
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return elapsed, size
+
+    compact = make(lambda val, path: cfg.PathCacheObject(val=val, path=path, ids=ids, mask=mask))
+    eager = make(lambda val, path: Eager(val, path, src))
+    print('index: {} nodes built in {:.1f}s. entries slotted {:.2f}s {:.0f}MB, with __dict__ {:.2f}s {:.0f}MB'.format(
+        len(items), built, compact[0], compact[1] / 2**20, eager[0], eager[1] / 2**20))
+
+
+
+def bench_paths():
+    """
+    On a Cfg with 200k indexed paths: a path search against the dpath walk of all the data it made
+    before, and the paths under a prefix from the path trie against a scan of the index keys
+    """
+    data = dict(('app{}'.format(i), dict(('k{}'.format(j), {'name': 'v', 'port': j, 'tags': ['a', 'b']})
+                                         for j in range(2000)))
+                for i in range(20))
+    c = cfg.Cfg(data=data, include_os_env=False, research=False)
+
+    walked = timed(lambda: list(dpath.util.search(c.data, 'app7/k100/port', yielded=True)), 1)
+    searched = timed(lambda: c.value('app7/k100/port'))
+    globbed = timed(lambda: c.values('app7/*/port'))
+    made = timed(lambda: cfg.PathTrie(c.path_index), 1)
+    c.path_trie
+    prefix = ('app7', 'k100')
+    scanned = timed(lambda: [p for p in c.path_index if p[:2] == prefix])
+    walk = timed(lambda: list(c.path_trie.walk(prefix)))
+    print('paths: {} paths. search app7/k100/port {:.4f}s, dpath walk {:.3f}s, app7/*/port {:.3f}s. '
+          'trie made in {:.2f}s, prefix walk {:.6f}s, scan {:.3f}s'.format(
+              len(c.path_index), searched, walked, globbed, made, walk, scanned))
+
+
+
+def bench_values():
+    """
+    Search by values without a path on 120k nodes: research of every node against the value index,
+    the first search after a refresh making it
+    """
+    data = dict(('app{}'.format(i), dict(('k{}'.format(j), {'name': 'svc{}-{}'.format(i, j), 'host': 'h{}'.format(j),
+                                                            'tags': ['a', 'b']})
+                                         for j in range(2000)))
+                for i in range(10))
+    scanned = cfg.Cfg(data=data, include_os_env=False, research=False, index_values=False)
+    indexed = cfg.Cfg(data=data, include_os_env=False, research=False)
+    assert indexed.search(values='svc3-77') == scanned.search(values='svc3-77')
+
+    research = timed(lambda: scanned.search(values='svc3-77'), 1)
+    indexed.refresh(load=False, research=False)
+    started = time.perf_counter()
+    indexed.search(values='svc3-77')
+    first = time.perf_counter() - started
+    exact = timed(lambda: indexed.search(values='svc3-77'))
+    substring = timed(lambda: indexed.search(values='-77'))
+    print('values: {} nodes. research {:.3f}s, index first search {:.3f}s then {:.4f}s, substring {:.3f}s'.format(
+        len(indexed.value_index.values), research, first, exact, substring))
+
+
+
+BENCHMARKS = dict((name[len('bench_'):], f) for name, f in sorted(globals().items()) if name.startswith('bench_'))
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
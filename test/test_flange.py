@@ -1,9 +1,13 @@
 
 import logging
+import asyncio
+import threading, time, json, copy
+import anyconfig
+import http.server
 from .context import *
 import pytest
 
-from flange import dbengine, iterutils, url_scheme_python as pyurl
+from flange import dbengine, discovery, iterutils, parsecache, source, watch, url_scheme_python as pyurl
 # from flange import Flange, url_scheme_python as pyurl
 
 # pyurl = url_scheme_python
@@ -300,8 +304,684 @@ def test_instantiate_from_explicit_file():
     assert f.search('contexts/default/vars')
 
 
+def test_unflatten():
+    data = {'a__b': {'c.d': 1, 'e': [{'f/g': 2}, 'h']}, 'a': {'i': 1}, 'plain': {'j': [1, {'k': 2}]}}
+    original = copy.deepcopy(data)
+
+    expanded = iterutils.unflatten(data, '__')
+    assert expanded == {'a': {'b': {'c': {'d': 1}, 'e': [{'f': {'g': 2}}, 'h']}, 'i': 1}, 'plain': {'j': [1, {'k': 2}]}}
+    assert data == original
+    # nothing to expand is kept as is
+    assert expanded['plain'] is data['plain']
+    assert iterutils.unflatten(data['plain'], '__') is data['plain']
+
+    assert iterutils.unflatten({'a__b': 1}, '__', replace=False) == {'a__b': 1, 'a': {'b': 1}}
+
+
+def test_merge_all_matches_anyconfig():
+    trees = [{'a': 'scalar'}] + [{'a': {'b': i, 'c': {'d': [i]}}, 'e{}'.format(i % 3): i} for i in range(10)]
+    trees += [{'a': {'again': 1}}, {'e0': {'x': 1}}, {'e0': {'y': 2}}]
+    expected = {}
+    for t in copy.deepcopy(trees):
+        anyconfig.merge(expected, t)
+
+    merged, failed = iterutils.run_steps(iterutils.merge_all_steps(trees))
+    assert merged == expected and not failed
+
+    # a scalar can't be merged into a mapping. The tree is reported and the rest still merged
+    merged, failed = iterutils.run_steps(iterutils.merge_all_steps([{'a': {'b': 1}}, {'a': 'x'}, {'c': 1}]))
+    assert merged == {'a': {'b': 1}, 'c': 1} and failed == [{'a': 'x'}]
+
+
+def test_fused_build(tmp_path):
+    make_tree(tmp_path, ['a.yml'])
+    data = {'a__x': {'y': [1, {'z': 2}]}, 'skip': {'w': 1}}
+    original = copy.deepcopy(data)
+    seen = {}
+
+    def key_filter(p, k, v):
+        seen[p + (k,)] = copy.deepcopy(v)
+        return k != 'skip'
+
+    f = flange.cfg.Cfg(base_dir=str(tmp_path), include_os_env=False, data=data, key_filter=key_filter)
+    assert f.data == {'a': {'x': {'y': [1, {'z': 2}]}}, 'skip': {'w': 1}}
+    assert f.value('a/x/y') == [1, {'z': 2}]
+    assert ('a', 'x', 'y') in f.path_index
+    assert not [p for p in f.path_index if 'skip' in p]
+
+    # the filter sees each collection complete, and merging the sources leaves them unchanged
+    assert seen[('a', 'x')] == {'y': [1, {'z': 2}]}
+    assert data == original
+    assert [s.contents for s in f.sources if s.uri == 'init_data'][0] == original
+
+
 def test_delayed_merge():
     f = flange.cfg.Cfg(base_dir=os.path.dirname(__file__), file_search_depth=1, merge=False)
     assert not f.search('command_name2')
     f.refresh(False, True, True)
     assert f.search('command_name2')
+
+
+def make_tree(root, files):
+    for f in files:
+        full = os.path.join(str(root), f)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        with open(full, 'w') as fh:
+            fh.write('{}: 1\n'.format(os.path.basename(f).split('.')[0]))
+
+
+def test_find_files_order_depth_and_excludes(tmp_path):
+    make_tree(tmp_path, [
+        'b.yml', 'a.yml', 'skip.zip', 'notes.txt',
+        'sub2/c.yml', 'sub1/d.yml', 'sub1/deeper/e.yml',
+        'node_modules/f.yml'])
+
+    found = flange.discovery.find_files(str(tmp_path), ['*.yml'], flange.cfg.DEFAULT_EXCLUDE_PATTERNS, 1)
+    assert [os.path.relpath(f, str(tmp_path)) for f in found] == [
+        'a.yml', 'b.yml', os.path.join('sub1', 'd.yml'), os.path.join('sub2', 'c.yml')]
+
+    assert len(flange.discovery.find_files(str(tmp_path), ['*.yml'], search_depth=0)) == 2
+    assert len(flange.discovery.find_files(str(tmp_path), ['*.yml'], search_depth=5, workers=1)) == 6
+
+
+def test_find_files_multiple_dirs_no_duplicates(tmp_path):
+    make_tree(tmp_path, ['a.yml', 'sub/b.yml'])
+    sub = os.path.join(str(tmp_path), 'sub')
+
+    found = flange.discovery.find_files([sub, str(tmp_path)], ['*.yml'], search_depth=1)
+    assert found == [os.path.join(sub, 'b.yml'), os.path.join(str(tmp_path), 'a.yml')]
+
+    f = flange.cfg.Cfg(base_dir=[sub, str(tmp_path)], file_search_depth=1, include_os_env=False)
+    assert [s.uri for s in f.sources] == found
+    f.refresh(gather=True)
+    assert [s.uri for s in f.sources] == found
+
+
+def test_discovery_manifest(tmp_path):
+    top = os.path.join(str(tmp_path), 'tree')
+    make_tree(top, ['a.yml', 'sub/b.yml'])
+    sub = os.path.join(top, 'sub')
+    # age the directories so their listings are trusted
+    for d in [top, sub]:
+        os.utime(d, ns=(0, 10**9))
+
+    path = os.path.join(str(tmp_path), 'manifest.json')
+    m = discovery.Manifest(path, ['*.yml'])
+    found = discovery.find_files(top, ['*.yml'], search_depth=1, manifest=m)
+    assert m.misses == 2 and m.hits == 0
+    m.save()
+    assert sorted(discovery.Manifest(path, ['*.yml']).dirs) == sorted([top, sub])
+
+    # unchanged directories are not listed again
+    m = discovery.Manifest(path, ['*.yml'])
+    assert discovery.find_files(top, ['*.yml'], search_depth=1, manifest=m) == found
+    assert m.hits == 2 and m.misses == 0
+
+    # a changed directory is
+    make_tree(top, ['sub/c.yml'])
+    m = discovery.Manifest(path, ['*.yml'])
+    assert len(discovery.find_files(top, ['*.yml'], search_depth=1, manifest=m)) == 3
+    assert m.hits == 1 and m.misses == 1
+
+    # different patterns do not reuse the manifest
+    assert not discovery.Manifest(path, ['*.json']).dirs
+
+    f = flange.cfg.Cfg(base_dir=top, file_search_depth=1, include_os_env=False, discovery_manifest=path)
+    assert len(f.sources) == 3
+
+
+def test_pattern_set_matches_fnmatch():
+    import fnmatch
+    patterns = flange.cfg.DEFAULT_FILE_PATTERNS + flange.cfg.DEFAULT_EXCLUDE_PATTERNS + ['a?c', '[xy]*.json']
+    ps = discovery.PatternSet(patterns)
+    for name in ['a.yml', '.cmd.yml', 'setup.cfg', 'ssh_config', 'x.json', 'y1.json', 'z.json', 'abc',
+                 'abbc', 'node_modules', 'node_modules2', 'target', 'file.swp', 'yml', 'app.settings.bak']:
+        assert bool(ps.match(name)) == any(fnmatch.fnmatch(name, p) for p in patterns), name
+
+    assert not discovery.PatternSet([]).match('a.yml')
+    assert discovery.PatternSet(['*']).match('anything')
+
+
+def wait_for(condition, timeout=5.0):
+    import time
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return condition()
+
+
+@pytest.mark.skipif(not flange.watch.available(), reason='inotify not available')
+def test_watch_add_modify_delete(tmp_path):
+    make_tree(tmp_path, ['b.yml'])
+    top = str(tmp_path)
+    f = flange.cfg.Cfg(base_dir=top, file_search_depth=1, include_os_env=False)
+    f.watch(latency=0.01)
+    try:
+        with open(os.path.join(top, 'a.yml'), 'w') as fh:
+            fh.write('watched: 1\n')
+        assert wait_for(lambda: f.value('watched') == 1)
+        assert [os.path.basename(s.uri) for s in f.sources] == ['a.yml', 'b.yml']
+
+        with open(os.path.join(top, 'a.yml'), 'w') as fh:
+            fh.write('watched: 2\n')
+        assert wait_for(lambda: f.value('watched') == 2)
+
+        make_tree(tmp_path, ['sub/c.yml'])
+        assert wait_for(lambda: f.value('c') == 1)
+
+        os.remove(os.path.join(top, 'a.yml'))
+        assert wait_for(lambda: f.value('watched') is None)
+        assert [os.path.basename(s.uri) for s in f.sources] == ['b.yml', 'c.yml']
+    finally:
+        f.unwatch()
+
+
+def test_unwatch_while_change_pending(tmp_path, monkeypatch):
+    monkeypatch.setattr(watch, 'STOP_TIMEOUT', 0.2)
+    make_tree(tmp_path, ['b.yml'])
+    top = str(tmp_path)
+    f = flange.cfg.Cfg(base_dir=top, file_search_depth=1, include_os_env=False)
+    watcher = f.watch(latency=0.01)
+
+    # the watcher thread is blocked on the lock with a change when unwatch is called
+    with f.lock:
+        with open(os.path.join(top, 'a.yml'), 'w') as fh:
+            fh.write('watched: 1\n')
+        time.sleep(0.3)
+        f.unwatch()
+
+    assert wait_for(lambda: not watcher.running())
+    assert f.value('watched') is None
+
+
+def test_file_source_guards(tmp_path):
+    top = str(tmp_path)
+    make_tree(tmp_path, ['ok.yml'])
+    with open(os.path.join(top, 'big.yml'), 'w') as fh:
+        fh.write('big: "{}"\n'.format('x' * 2000))
+    with open(os.path.join(top, 'dump.config'), 'wb') as fh:
+        fh.write(b'key: \x00\x01\x02\x03')
+    with open(os.path.join(top, 'latin.settings'), 'wb') as fh:
+        fh.write(b'name: caf\xe9\n')
+
+    f = flange.cfg.Cfg(base_dir=top, include_os_env=False, max_file_size=1000)
+    errors = {os.path.basename(s.uri): s.error for s in f.sources}
+    assert errors['ok.yml'] is None
+    assert isinstance(errors['big.yml'], flange.source.SourceRejected)
+    assert 'size' in errors['big.yml'].reason
+    assert 'binary' in errors['dump.config'].reason
+    assert 'utf-8' in errors['latin.settings'].reason
+    assert f.value('ok') == 1
+    assert not f.value('big')
+
+    f = flange.cfg.Cfg(base_dir=top, include_os_env=False, max_file_size=None)
+    assert f.value('big')
+
+
+@pytest.mark.parametrize('mode', ['thread', 'process'])
+def test_concurrent_load_keeps_order(tmp_path, mode):
+    top = str(tmp_path)
+    for i in range(12):
+        with open(os.path.join(top, 'f{:02d}.yml'.format(i)), 'w') as fh:
+            fh.write('shared: {}\nf{:02d}: {{v: {}}}\n'.format(i, i, i))
+    with open(os.path.join(top, 'f99.yml'), 'w') as fh:
+        fh.write('shared: [unclosed\n')
+
+    serial = flange.cfg.Cfg(base_dir=top, include_os_env=False)
+    f = flange.cfg.Cfg(base_dir=top, include_os_env=False, load_workers=4, load_mode=mode)
+    assert [s.uri for s in f.sources] == [s.uri for s in serial.sources]
+    assert f.data == serial.data
+    assert f.value('shared') == 11
+    assert f.sources[-1].error
+
+
+def test_process_load_skips_old_contents(tmp_path):
+    top = str(tmp_path)
+    make_tree(tmp_path, ['a.yml', 'b.yml'])
+    sources = [source.SourceFile(os.path.join(top, n)) for n in ['a.yml', 'b.yml']]
+
+    # contents left from an earlier load are not sent to the workers. this would not pickle
+    for s in sources:
+        s.contents = {'old': lambda: None}
+    source.load_all(sources, workers=2, mode='process')
+    assert [s.contents for s in sources] == [{'a': 1}, {'b': 1}]
+
+
+class ConfigHandler(http.server.BaseHTTPRequestHandler):
+    # served body, etag, and the (client port, If-None-Match) of each request
+    protocol_version = 'HTTP/1.1'
+    body = b'{"app": {"port": 1}}'
+    etag = '"1"'
+    requests = []
+
+    def do_GET(self):
+        ConfigHandler.requests.append((self.client_address[1], self.headers.get('If-None-Match')))
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_http_source():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ConfigHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}/config'.format(server.server_address[1])
+    ConfigHandler.requests = []
+    try:
+        f = flange.cfg.Cfg(urls=url, file_patterns=None, include_os_env=False, root_path='remote')
+        assert f.value('remote/app/port') == 1
+        contents = f.sources[0].contents
+
+        # not modified. the contents already parsed are kept
+        assert f.refresh(incremental=True)
+        assert f.sources[0].status == 304 and f.sources[0].contents is contents
+
+        ConfigHandler.body, ConfigHandler.etag = b'{"app": {"port": 2}}', '"2"'
+        f.refresh()
+        assert f.value('remote/app/port') == 2
+
+        # one keep-alive connection for all three requests
+        assert [r[1] for r in ConfigHandler.requests] == [None, '"1"', '"1"']
+        assert len(set(r[0] for r in ConfigHandler.requests)) == 1
+    finally:
+        server.shutdown()
+        server.server_close()
+        flange.httppool.POOL.close()
+
+    f = flange.cfg.Cfg(urls=url, file_patterns=None, include_os_env=False, http_timeout=0.5)
+    assert f.sources[0].error and not f.data
+
+
+def test_filtered_os_env(monkeypatch):
+    for name, value in [('FLAPP_DB__HOST', 'h'), ('FLAPP_PORT', '1'), ('FLCI_JOB', 'j'), ('FLCIX', 'x'), ('FLOTHER', 'o')]:
+        monkeypatch.setenv(name, value)
+
+    f = flange.cfg.from_os_env(patterns=['FLAPP_', 'FLCI_*B'], strip_prefix=True)
+    assert f.data == {'DB': {'HOST': 'h'}, 'PORT': '1', 'JOB': 'j'}
+    assert set(p[0] for p in f.path_index) == {None, 'DB', 'PORT', 'JOB'}
+
+    f = flange.cfg.from_os_env(patterns=['FLAPP_PORT', 'FLCI*'])
+    assert f.data == {'FLAPP_PORT': '1', 'FLCI_JOB': 'j', 'FLCIX': 'x'}
+
+
+def test_parse_cache(tmp_path):
+    top = os.path.join(str(tmp_path), 'tree')
+    make_tree(top, ['a.yml', 'b.config'])
+    cache = flange.parsecache.ParseCache(os.path.join(str(tmp_path), 'cache'))
+
+    # just written files are parsed but not cached
+    f = flange.cfg.Cfg(base_dir=top, include_os_env=False, parse_cache=cache)
+    f = flange.cfg.Cfg(base_dir=top, include_os_env=False, parse_cache=cache)
+    assert not [s for s in f.sources if s.cached]
+    assert cache.misses == 4
+
+    for name in ['a.yml', 'b.config']:
+        os.utime(os.path.join(top, name), ns=(0, 10**9))
+    f = flange.cfg.Cfg(base_dir=top, include_os_env=False, parse_cache=cache)
+    assert not [s for s in f.sources if s.cached]
+
+    f = flange.cfg.Cfg(base_dir=top, include_os_env=False, parse_cache=cache, load_workers=2, load_mode='process')
+    assert all(s.cached for s in f.sources)
+    assert f.value('a') == 1 and f.value('b') == 1
+    assert [s.parser for s in f.sources] == ['yml', 'yaml']
+
+    # a changed file is parsed again
+    with open(os.path.join(top, 'a.yml'), 'w') as fh:
+        fh.write('a: 22\n')
+    os.utime(os.path.join(top, 'a.yml'), ns=(0, 10**9))
+    f = flange.cfg.Cfg(base_dir=top, include_os_env=False, parse_cache=cache)
+    assert f.value('a') == 22
+    assert [s.cached for s in f.sources] == [False, True]
+
+
+def test_parse_cache_eviction(tmp_path):
+    cache = flange.parsecache.ParseCache(str(tmp_path), max_size=20000)
+    for i in range(50):
+        assert cache.put(('k', i), {'v': 'x' * 1000}, 'yaml')
+    total = sum(os.path.getsize(os.path.join(str(tmp_path), n)) for n in os.listdir(str(tmp_path)))
+    assert total <= 20000 + 2000
+    assert cache.get(('k', 49)) == ({'v': 'x' * 1000}, 'yaml')
+    assert cache.get(('k', 0)) is None
+
+
+def test_sniff_parsers():
+    assert source.sniff_parsers(b'<?xml version="1.0"?><a/>') == ['xml']
+    assert source.sniff_parsers(b'  {"a": 1}') == ['json', 'yaml']
+    assert source.sniff_parsers(b'---\na: 1') == ['yaml']
+    assert source.sniff_parsers(b'# comment\n[core]\n\tbare = false\n')[0] == 'ini'
+    assert source.sniff_parsers(b'[1, 2]')[0] == 'json'
+    assert source.sniff_parsers(b'export PATH=/bin\n')[0] == 'shellvars'
+    assert source.sniff_parsers(b'some.key = value\n')[-1] == 'properties'
+    assert source.sniff_parsers(b'key: value\n')[0] == 'yaml'
+
+
+def test_sniffed_parser_recorded(tmp_path):
+    top = str(tmp_path)
+    with open(os.path.join(top, 'app.config'), 'w') as fh:
+        fh.write('[server]\nport = 80\n')
+    with open(os.path.join(top, 'other.settings'), 'w') as fh:
+        fh.write('name: sniffed\n')
+
+    f = flange.cfg.Cfg(base_dir=top, include_os_env=False)
+    parsers = {os.path.basename(s.uri): s.parser for s in f.sources}
+    assert parsers == {'app.config': 'ini', 'other.settings': 'yaml'}
+    assert all(s.detect_time is not None for s in f.sources)
+    assert f.value('server/port') == '80'
+    assert f.value('name') == 'sniffed'
+
+
+def test_incremental_refresh(tmp_path):
+    top = str(tmp_path)
+    make_tree(tmp_path, ['a.yml', 'b.yml', 'c.yml'])
+    f = flange.cfg.Cfg(base_dir=top, include_os_env=False)
+    assert f.refresh(incremental=True) == []
+
+    with open(os.path.join(top, 'b.yml'), 'w') as fh:
+        fh.write('b: changed\n')
+    os.utime(os.path.join(top, 'b.yml'), ns=(0, 10**9))
+    os.remove(os.path.join(top, 'c.yml'))
+
+    loaded = f.refresh(incremental=True)
+    assert [os.path.basename(s.uri) for s in loaded] == ['b.yml', 'c.yml']
+    assert f.value('b') == 'changed'
+    assert f.value('a') == 1
+    assert f.value('c') is None
+    assert f.refresh(incremental=True) == []
+
+
+def test_incremental_remerge(tmp_path):
+    top = str(tmp_path)
+    logger = {'name': 'remerged', 'level': 'DEBUG', 'format': '%(message)s'}
+    for name, contents in [('a.json', {'a': {'x': 1}, 'shared': {'a': 1}}),
+                           ('b.json', {'b': {'y': 2}, 'shared': {'b': 1}})]:
+        with open(os.path.join(top, name), 'w') as fh:
+            json.dump(contents, fh)
+    f = flange.cfg.Cfg(base_dir=top, file_patterns=['*.json'], include_os_env=False)
+    untouched = f.data['a']
+
+    with open(os.path.join(top, 'b.json'), 'w') as fh:
+        json.dump({'log': logger, 'shared': {'b': 2}}, fh)
+    os.utime(os.path.join(top, 'b.json'), ns=(0, 10**9))
+    f.refresh(incremental=True)
+
+    # only what b.json contributes to was merged again
+    assert f.data['a'] is untouched
+    expected = flange.cfg.Cfg(base_dir=top, file_patterns=['*.json'], include_os_env=False)
+    assert f.data == expected.data
+    assert set(f.path_index) == set(expected.path_index)
+    assert [os.path.basename(s.uri) for s in f.path_index[('shared', 'b')].srcs] == ['b.json']
+    assert f.obj('log').name == 'remerged'
+
+
+def test_source_id_provenance(tmp_path):
+    top = str(tmp_path)
+    for name, contents in [('a.json', {'a': {'x': 1, 'y': 1}, 'shared': 1}), ('b.json', {'b': 1, 'shared': 2})]:
+        with open(os.path.join(top, name), 'w') as fh:
+            json.dump(contents, fh)
+    f = flange.cfg.Cfg(base_dir=top, file_patterns=['*.json'], include_os_env=False)
+    a, b = f.sources
+
+    shared = f.path_index[('shared',)]
+    assert shared.srcs == {a, b} and shared.has_src(b)
+    assert sorted(f.uris('shared')) == sorted([a.uri, b.uri])
+    # the entries of one source share its mask
+    assert f.path_index[('a', 'x')].mask is f.path_index[('a', 'y')].mask is f.source_ids.mask(a)
+
+    shared.srcs.discard(a)
+    assert shared.srcs == {a, b}
+    copied = shared.copy()
+    copied.discard_src(a)
+    assert copied.srcs == {b} and shared.srcs == {a, b}
+
+
+def test_snapshots(tmp_path):
+    top = str(tmp_path)
+    with open(os.path.join(top, 'a.json'), 'w') as fh:
+        json.dump({'a': {'x': 1}, 'log': {'name': 'snap', 'level': 'DEBUG', 'format': '%(message)s'}}, fh)
+    f = flange.cfg.Cfg(base_dir=top, file_patterns=['*.json'], include_os_env=False)
+    first = f.snapshot
+    with pytest.raises(AttributeError):
+        first.data = {}
+
+    with open(os.path.join(top, 'a.json'), 'w') as fh:
+        json.dump({'a': {'x': 2}}, fh)
+    os.utime(os.path.join(top, 'a.json'), ns=(0, 10**9))
+    f.refresh()
+
+    # a snapshot taken before a refresh still reads as it was
+    assert f.generation == first.generation + 1
+    assert first.data['a'] == {'x': 1} and first.path_index[('a', 'x')].val == 1
+    assert first.path_index[('log',)].mregs
+    assert f.value('a/x') == 2 and ('log',) not in f.path_index
+
+    # registering a model publishes a new snapshot too, leaving the entries of the last one as they were
+    model = flange.model.Model('has_x', lambda v: isinstance(v, dict) and 'x' in v, lambda v: v['x'])
+    second = f.snapshot
+    f.register_model('has_x', model)
+    assert f.generation == second.generation + 1
+    assert f.obj('a', model='has_x') == 2
+    assert not second.path_index[('a',)].mregs
+
+
+def test_lazy_namespace_loading(tmp_path):
+    top = str(tmp_path)
+    make_tree(tmp_path, ['a.yml', 'b.yml'])
+    f = flange.cfg.Cfg(base_dir=top, include_os_env=False, root_path='ns', lazy=True, data={'other': {'x': 1}})
+    assert not [s for s in f.sources if isinstance(s, source.SourceFile) and s.loaded]
+
+    # a search outside the namespace of the file sources loads nothing
+    assert f.value('other/x') == 1
+    assert not [s for s in f.sources if isinstance(s, source.SourceFile) and s.loaded]
+
+    assert f.value('ns/a') == 1
+    assert all(s.loaded for s in f.sources)
+    assert f.value('ns/b') == 1
+    assert f.value('other/x') == 1
+
+    f = flange.cfg.Cfg(base_dir=top, include_os_env=False, root_path='ns', lazy=True)
+    assert len(f.search('**/b')) == 1
+    assert all(s.loaded for s in f.sources)
+
+
+def test_lazy_namespace_per_file(tmp_path):
+    top = str(tmp_path)
+    make_tree(tmp_path, ['a.yml', 'b.yml'])
+    f = flange.cfg.Cfg(base_dir=top, include_os_env=False, lazy=True,
+                       root_path=lambda uri: os.path.splitext(os.path.basename(uri))[0])
+
+    assert f.value('b/b') == 1
+    assert [os.path.basename(s.uri) for s in f.sources if s.loaded] == ['b.yml']
+    assert f.value('a/a') == 1
+    assert all(s.loaded for s in f.sources)
+
+
+@pytest.mark.parametrize('root_path', [None, 'ns__sub'])
+def test_stream_source_matches_load(tmp_path, root_path):
+    top = str(tmp_path)
+    with open(os.path.join(top, 'a.yml'), 'w') as fh:
+        fh.write('app:\n  port: 8080\n  hosts: [a, {b__c: 2}]\n  base: &B {k: v}\n  ref: *B\n'
+                 'db__host: localhost\ndotted.key: 1\n')
+    with open(os.path.join(top, 'b.json'), 'w') as fh:
+        fh.write('{"app": {"port": 9090, "ratio": 1.5, "on": true, "off": null, "big": 1e5, "name": "n"}}')
+
+    args = dict(base_dir=top, file_patterns=['*.yml', '*.json'], include_os_env=False, root_path=root_path)
+    loaded = flange.cfg.Cfg(**args)
+    streamed = flange.cfg.Cfg(stream_file_size=0, **args)
+
+    assert all(isinstance(s, source.SourceFileStream) and not s.error for s in streamed.sources)
+    assert streamed.data == loaded.data
+    assert sorted(streamed.path_index, key=str) == sorted(loaded.path_index, key=str)
+    assert streamed.uri('**/ratio') == loaded.uri('**/ratio')
+
+
+def test_stream_json_escapes(tmp_path):
+    top = str(tmp_path)
+    contents = {'app': {'name': 'caf\u00e9 \U0001f600', 'tags': ['\U00010348', 'a"b\\c'], 'n': -1.5e-07}}
+    with open(os.path.join(top, 'a.json'), 'w') as fh:
+        fh.write(json.dumps(contents))
+
+    f = flange.cfg.Cfg(base_dir=top, file_patterns=['*.json'], include_os_env=False, stream_file_size=0)
+    assert not f.sources[0].error
+    assert f.data == contents
+
+
+def test_stream_failure_leaves_no_index(tmp_path):
+    top = str(tmp_path)
+    with open(os.path.join(top, 'a.yml'), 'w') as fh:
+        fh.write('good: 1\nbase: &B {k: v}\nbad:\n  <<: *B\n')
+
+    f = flange.cfg.Cfg(base_dir=top, file_patterns=['*.yml'], include_os_env=False, stream_file_size=0)
+    assert f.sources[0].error
+    assert not f.path_index
+    assert f.value('good') is None
+
+
+def test_mmap_parse(tmp_path):
+    path = os.path.join(str(tmp_path), 'a.json')
+    with open(path, 'wb') as fh:
+        # with a utf-8 byte order mark
+        fh.write(b'\xef\xbb\xbf{"a": {"b": [1, "caf\xc3\xa9"]}}')
+
+    read = source.SourceFile(path, mmap_size=None)
+    read.load()
+    mapped = source.SourceFile(path, mmap_size=1)
+    mapped.load()
+    assert not mapped.error
+    assert mapped.contents == read.contents == {'a': {'b': [1, 'café']}}
+
+
+def test_async_create_and_refresh(tmp_path):
+    top = str(tmp_path)
+    make_tree(tmp_path, ['a.yml', 'b.yml'])
+    data = dict(('k{}'.format(i), {'v': i}) for i in range(50))
+    ticks = []
+    seen = []
+
+    async def ticker(f):
+        while True:
+            ticks.append(1)
+            # readers on the loop never see a partly built state
+            seen.append(f.value('k10/v'))
+            await asyncio.sleep(0)
+
+    async def main():
+        f = await flange.cfg.Cfg.create(base_dir=top, include_os_env=False, data=data, root_path='ns')
+        t = asyncio.ensure_future(ticker(f))
+        before = len(ticks)
+        loaded = await asyncio.gather(f.arefresh(budget=0), f.arefresh(budget=0))
+        # the loop ran between merge and research steps
+        assert len(ticks) - before > 4
+        t.cancel()
+        return f, loaded
+
+    f, loaded = asyncio.run(main())
+    expected = flange.cfg.Cfg(base_dir=top, include_os_env=False, data=data, root_path='ns')
+    assert f.data == expected.data
+    assert set(f.path_index) == set(expected.path_index)
+    assert [len(l) for l in loaded] == [3, 3]
+    assert f.value('k49/v') == 49
+    assert seen and set(seen) == {10}
+
+
+def test_compact_index_entries(tmp_path):
+    top = str(tmp_path)
+    for name in ['a.yml', 'b.yml']:
+        with open(os.path.join(top, name), 'w') as fh:
+            fh.write('{}:\n  name: x\n  log:\n    name: l\n    level: DEBUG\n    format: "%(message)s"\n'.format(name[0]))
+    f = flange.cfg.Cfg(base_dir=top, file_patterns=['*.yml'], include_os_env=False)
+
+    entry = f.path_index[('a', 'name')]
+    assert not hasattr(entry, '__dict__')
+    # no registrations dict until a model is added
+    assert not entry.mregs and entry._mregs is None
+    with pytest.raises(TypeError):
+        entry.mregs['m'] = None
+    assert f.path_index[('a', 'log')].mregs and f.obj('a/log', model='logger')
+
+    # the entry path is the index key, and equal keys of different sources are one string
+    key = [p for p in f.path_index if p == ('a', 'name')][0]
+    assert entry.path is key
+    assert f.path_index[('b', 'name')].path[1] is entry.path[1]
+    assert [k for k in f.data['b'] if k == 'name'][0] is entry.path[1]
+
+
+def test_path_trie(tmp_path):
+    top = str(tmp_path)
+    with open(os.path.join(top, 'a.json'), 'w') as fh:
+        json.dump({'app': {'web': {'port': 1, 'hosts': ['h1', 'h2']}, 'db': {'port': 2}}, 'other': {'port': 3}}, fh)
+    f = flange.cfg.Cfg(base_dir=top, file_patterns=['*.json'], include_os_env=False)
+
+    trie = f.path_trie
+    assert set(trie.walk()) == set(f.path_index) - {(None,)} and len(trie) == len(f.path_index) - 1
+    assert ('app', 'web', 'hosts', 1) in trie and ('app', 'x') not in trie
+    assert trie.children(('app',)) == ['web', 'db']
+    assert list(trie.walk(('app', 'db'))) == [('app', 'db'), ('app', 'db', 'port')]
+    assert set(trie.match('app/*/port')) == {('app', 'web', 'port'), ('app', 'db', 'port')}
+    assert set(trie.match('**/port')) == {('app', 'web', 'port'), ('app', 'db', 'port'), ('other', 'port')}
+    assert list(trie.match('app/web/hosts/1')) == [('app', 'web', 'hosts', 1)]
+
+    # a trie made from another leaves it as it was
+    copied = flange.cfg.PathTrie(base=trie)
+    assert copied.discard(('app', 'web')) == [('app', 'web'), ('app', 'web', 'port'), ('app', 'web', 'hosts'),
+                                              ('app', 'web', 'hosts', 0), ('app', 'web', 'hosts', 1)]
+    assert ('app', 'web', 'port') not in copied and ('app', 'web', 'port') in trie
+
+    # later builds keep the trie up to date
+    with open(os.path.join(top, 'a.json'), 'w') as fh:
+        json.dump({'app': {'db': {'port': 2, 'user': 'u'}}, 'other': {'port': 3}}, fh)
+    os.utime(os.path.join(top, 'a.json'), ns=(0, 10**9))
+    f.refresh(incremental=True)
+    assert f.snapshot._path_trie is not None
+    assert set(f.path_trie.walk()) == set(f.path_index) - {(None,)}
+    assert ('app', 'web') in trie and ('app', 'web') not in f.path_trie
+
+
+def test_search_prunes_data():
+    data = {'a': {'b': 1, 'c': {'b': 2}}, 'x': {'': 1, 'b': 3}, 0: {'b': 4}}
+    assert iterutils.search(data, 'a/b') == [(('a', 'b'), 1)]
+    assert iterutils.search(data, 'a/*/b') == [(('a', 'c', 'b'), 2)]
+    # keys that aren't str are matched by their str
+    assert iterutils.search(data, '0/b') == [(('0', 'b'), 4)]
+    # dpath refuses the empty key, which only searches that walk the keys of x now see
+    assert iterutils.search(data, 'x/b') == [(('x', 'b'), 3)]
+    with pytest.raises(Exception):
+        iterutils.search(data, 'x/*')
+
+
+def test_value_index(tmp_path):
+    top = str(tmp_path)
+    with open(os.path.join(top, 'a.json'), 'w') as fh:
+        json.dump({'apps': {'web': {'name': 'myapp', 'tags': ['front', 'myapp']}, 'db': {'name': 'pg', 'port': 5432}},
+                   'owner': {'myapp': {'x': 'y'}}, 'note': 'see myapp-docs'}, fh)
+    indexed = flange.cfg.Cfg(base_dir=top, file_patterns=['*.json'], include_os_env=False)
+    scanned = flange.cfg.Cfg(base_dir=top, file_patterns=['*.json'], include_os_env=False, index_values=False)
+
+    for values in ['myapp', ['myapp', 'front'], 'pg', 'docs', ['myapp', 'missing'], 'nothing']:
+        assert indexed.search(values=values) == scanned.search(values=values)
+    assert indexed.snapshot._value_index is not None and scanned.snapshot._value_index is None
+    assert [p for p, v in indexed.search(values='myapp')] == [
+        (None,), ('apps', 'web'), ('apps', 'web', 'name'), ('apps', 'web', 'tags'), ('apps', 'web', 'tags', 1), ('note',)]
+    # a mapping with a value the term can't be in, like a number, doesn't match
+    assert indexed.paths(values='pg') == [('apps', 'db', 'name')]
+
+    # kept while the data is, made again for new data
+    index = indexed.value_index
+    indexed.register_model('named', flange.model.Model('named', lambda v: isinstance(v, dict) and 'name' in v, lambda v: v))
+    assert indexed.value_index is index
+    with open(os.path.join(top, 'a.json'), 'w') as fh:
+        json.dump({'apps': {'web': {'name': 'other'}}}, fh)
+    os.utime(os.path.join(top, 'a.json'), ns=(0, 10**9))
+    indexed.refresh()
+    assert indexed.value_index is not index and indexed.search(values='myapp') is None